@@ -2,22 +2,36 @@
 # Copyright 2024 ERPGAP/PROMPTEQUATION LDA
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
 
-import os
+import gzip
 import json
 import logging
 import pprint
+import re
 
-from odoo import http
+from graphql import OperationType, execute, get_operation_ast
+from graphql_server import encode_execution_results, format_error_default, json_encode
+from odoo import fields, http
 from odoo.addons.web.controllers.binary import Binary
 from odoo.addons.graphql_base import GraphQLControllerMixin
 from odoo.http import request, Response
-from urllib.parse import urlparse
-from werkzeug.exceptions import Forbidden
+from odoo.tools import SQL
+from werkzeug.exceptions import BadRequest, Forbidden
 
+from ..models.ir_binary import negotiate_image_format, snap_image_size
 from ..schema import schema
+from ..schemas.objects import get_image_unique_id
+from .persisted_query import (
+    persisted_query_cache, get_query_hash, is_query_hash, parse_and_validate,
+    load_persisted_query, save_persisted_query
+)
+from .response_cache import is_cacheable_document, CacheTagMiddleware
+from .sitemap import get_product_route, iter_slug_batches, stream_json
 
 _logger = logging.getLogger(__name__)
 
+# Filenames generated by get_image_filename start with the hexadecimal write_date of the record
+IMAGE_FILENAME_UNIQUE_RE = re.compile(r'^([0-9a-f]{8,})(?:_|$)')
+
 
 class AlokaiBinary(Binary):
     @http.route(['/web/image',
@@ -42,28 +56,53 @@ class AlokaiBinary(Binary):
                     filename_field='name', filename=None, mimetype=None, unique=False,
                     download=False, width=0, height=0, crop=False, access_token=None,
                     nocache=False):
-        """ Validate width and height """
+        """ Validate width and height, snap them to the configured sizes and negotiate the output format """
+        settings = request.env['alokai.settings']
         try:
-            ICP = request.env['ir.config_parameter'].sudo()
-            alokai_image_resize_limit = int(ICP.get_param('alokai_image_resize_limit', 1920))
-            
+            alokai_image_resize_limit = settings.get('alokai_image_resize_limit')
+
             if width > alokai_image_resize_limit or height > alokai_image_resize_limit:
                 return request.not_found()
         except Exception:
             return request.not_found()
 
-        return super(AlokaiBinary, self).content_image(
+        # The unique id of the filename versions the url, so the image can be cached as immutable, only when it is
+        # the current version of the record, an outdated or made up filename must not be cached forever
+        if not unique and filename and model != 'ir.attachment' and id:
+            match = IMAGE_FILENAME_UNIQUE_RE.match(filename)
+            if match and match.group(1) == self._get_image_unique_id(model, id, field):
+                unique = match.group(1)
+
+        if width or height:
+            width, height = snap_image_size(width, height, settings.get('alokai_image_breakpoints'))
+        request.update_context(alokai_image_format=negotiate_image_format(request.httprequest.headers.get('Accept')))
+
+        response = super(AlokaiBinary, self).content_image(
             xmlid=xmlid, model=model, id=id, field=field, filename_field=filename_field, filename=filename,
             mimetype=mimetype, unique=unique, download=download, width=width, height=height, crop=crop,
             access_token=access_token, nocache=nocache)
+        response.vary.add('Accept')
+        return response
+
+    def _get_image_unique_id(self, model, res_id, field):
+        """
+        Return the unique id get_image_filename generates for the record, None when it does not version the image:
+        the field is not stored on the record itself, as the variant image falling back to the template one, or the
+        record was written during the current second, the timestamp would not change on another write within it
+        """
+        if model not in request.env or not getattr(request.env[model]._fields.get(field), 'store', False):
+            return None
+        record = request.env[model].sudo().browse(int(res_id)).exists()
+        if not record or int(record.write_date.timestamp()) >= int(fields.Datetime.now().timestamp()):
+            return None
+        return get_image_unique_id(record)
 
 
 class GraphQLController(http.Controller, GraphQLControllerMixin):
 
     def _process_request(self, schema, data):
         # Set the alokai_debug_mode value that exist in the settings
-        ICP = http.request.env['ir.config_parameter'].sudo()
-        alokai_debug_mode = ICP.get_param('alokai_debug_mode', False)
+        alokai_debug_mode = http.request.env['alokai.settings'].get('alokai_debug_mode')
         if alokai_debug_mode:
             try:
                 request = http.request.httprequest
@@ -88,30 +127,160 @@ class GraphQLController(http.Controller, GraphQLControllerMixin):
                 _logger.info('# ------------------------------------------------------------------------------------ #')
             except:
                 pass
-        return super(GraphQLController, self)._process_request(schema, data)
+
+        # Batched queries keep the default processing
+        if isinstance(data, list):
+            return super(GraphQLController, self)._process_request(schema, data)
+        return self._process_persisted_query(schema, data)
+
+    def _graphql_error_response(self, message, status=400, code=None):
+        error = {'message': message}
+        if code:
+            error['extensions'] = {'code': code}
+        return Response(
+            json_encode({'errors': [error]}),
+            status=status,
+            headers={'Content-Type': 'application/json'},
+        )
+
+    def _get_graphql_params(self, data):
+        """ Merge the query string and the body, decoding the JSON encoded variables and extensions of GET requests """
+        params = dict(request.httprequest.args.items())
+        params.update(data or {})
+
+        for param in ('variables', 'extensions'):
+            value = params.get(param)
+            if isinstance(value, str):
+                params[param] = json.loads(value) if value else None
+
+        return params
+
+    def _process_persisted_query(self, schema, data):
+        """
+        Automatic persisted queries: the client may send the sha256 hash of the query instead of the query.
+        The parsed and validated documents are kept in a LRU keyed by that hash, so the storefront queries, which
+        are always the same, are only parsed and validated once per worker. The queries are persisted on the
+        filestore so any worker can answer a hash registered on another one.
+        The cached document is executed directly, with the GET mutation check, the error formatting and the rollback
+        of the default processing.
+        """
+        try:
+            params = self._get_graphql_params(data)
+        except ValueError:
+            return self._graphql_error_response('Variables are invalid JSON.')
+
+        query = params.get('query')
+        variables = params.get('variables')
+        operation_name = params.get('operationName')
+        extensions = params.get('extensions') or {}
+        persisted_query = isinstance(extensions, dict) and extensions.get('persistedQuery') or {}
+        query_hash = persisted_query.get('sha256Hash') if isinstance(persisted_query, dict) else None
+
+        if not query and not query_hash:
+            return self._graphql_error_response('Must provide query string.')
+
+        if query_hash and not is_query_hash(query_hash):
+            return self._graphql_error_response('Invalid persisted query hash.')
+
+        if query and query_hash and get_query_hash(query) != query_hash:
+            return self._graphql_error_response('Provided sha does not match query.')
+
+        query_hash = query_hash or get_query_hash(query)
+        document = persisted_query_cache.get(query_hash)
+
+        if document is None:
+            dbname = request.env.cr.dbname
+
+            if not query:
+                query = load_persisted_query(dbname, query_hash)
+                if not query:
+                    return self._graphql_error_response(
+                        'PersistedQueryNotFound', status=200, code='PERSISTED_QUERY_NOT_FOUND')
+
+            document, errors = parse_and_validate(schema, query)
+            if errors:
+                return Response(
+                    json_encode({'errors': [format_error_default(error) for error in errors]}),
+                    status=400,
+                    headers={'Content-Type': 'application/json'},
+                )
+
+            persisted_query_cache.set(query_hash, document)
+            if persisted_query:
+                save_persisted_query(dbname, query_hash, query)
+
+        # Like the default processing, a GET request can only run a query, a mutation must be POSTed
+        if request.httprequest.method == 'GET':
+            operation = get_operation_ast(document, operation_name)
+            if operation and operation.operation != OperationType.QUERY:
+                return Response(
+                    json_encode({'errors': [{'message': 'Can only perform a {} operation from a POST request.'.format(
+                        operation.operation.value)}]}),
+                    status=405,
+                    headers={'Content-Type': 'application/json', 'Allow': 'POST'},
+                )
+
+        # The cached document is executed as is, the query is never parsed nor validated again
+        cache_key = self._get_response_cache_key(document, query_hash, operation_name, variables)
+        if cache_key:
+            result = request.env['alokai.graphql.cache']._get(cache_key)
+            if result is not None:
+                return Response(result, headers={'Content-Type': 'application/json', 'X-Alokai-Cache': 'HIT'})
+
+        # The middleware collects the cache tags of the cacheable catalog responses
+        tag_middleware = CacheTagMiddleware() if cache_key else None
+        execution_result = execute(
+            schema,
+            document,
+            context_value={'env': request.env},
+            variable_values=variables,
+            operation_name=operation_name,
+            middleware=[tag_middleware] if tag_middleware else None,
+        )
+        result, status_code = encode_execution_results(
+            [execution_result], format_error=format_error_default, is_batch=False, encode=json_encode)
+
+        headers = {'Content-Type': 'application/json'}
+        if execution_result.errors:
+            request.env.cr.rollback()
+            request.env.clear()
+        elif cache_key:
+            request.env['alokai.graphql.cache']._set(cache_key, result, tag_middleware.tags)
+            headers['X-Alokai-Cache'] = 'MISS'
+        return Response(result, status=status_code, headers=headers)
+
+    def _get_response_cache_key(self, document, query_hash, operation_name, variables):
+        """
+        Return the response cache key of the query, or None when the response must not be cached.
+        Only the catalog queries of the website public user are cached, their response only depends on the query,
+        the variables, the website, the language and the pricelist.
+        """
+        env = request.env
+        website = getattr(request, 'website', None)
+        if not website or not env['alokai.graphql.cache']._is_enabled():
+            return None
+        if env.uid != website.sudo().user_id.id or not is_cacheable_document(document, operation_name):
+            return None
+
+        pricelist = website._get_current_pricelist()
+        return env['alokai.graphql.cache']._get_key(
+            query_hash, operation_name, variables, website.id, env.lang, pricelist.id)
 
     def _set_website_context(self):
         """Set website context based on http_request_host header."""
-        website = None
-        try:
-            request_host = request.httprequest.headers.environ.get('HTTP_RESQUEST_HOST')
-            if not request_host.startswith(('http://', 'https://')):
-                request_host = f'https://{request_host}'
-            website = request.env['website'].search([('domain', '=', request_host)], limit=1)
-        except:
-            pass
+        request_host = request.httprequest.headers.environ.get('HTTP_RESQUEST_HOST')
+        if request_host and not request_host.startswith(('http://', 'https://')):
+            request_host = f'https://{request_host}'
 
-        if not website:
-            website = request.env['website'].search([], limit=1)
+        website_id, lang, website_uid = request.env['website']._get_alokai_website_context(request_host or None)
 
         request.update_context(
-            website_id=website.id,
-            lang=website.default_lang_id.code,
+            website_id=website_id,
+            lang=lang,
         )
-        request.website = website
+        request.website = request.env['website'].browse(website_id)
 
         request_uid = request.env.uid
-        website_uid = website.sudo().user_id.id
 
         if request_uid != website_uid \
                 and request.env['res.users'].sudo().browse(request_uid).has_group('base.group_public'):
@@ -137,59 +306,49 @@ class GraphQLController(http.Controller, GraphQLControllerMixin):
         self._set_website_context()
         return self._handle_graphql_request(schema.graphql_schema)
 
-    @http.route(['/alokai/categories', '/vsf/categories'], type='http', auth='public', csrf=False)
-    def alokai_categories(self):
+    def _get_sitemap_response(self, table, condition, to_item=None, since=None, output_format=None):
+        """ Stream the slugs of the table visible on the website, only those modified since the given date if any """
         self._set_website_context()
         website = request.env['website'].get_current_website()
 
-        categories = []
+        if since:
+            try:
+                since = fields.Datetime.to_datetime(since)
+            except ValueError:
+                raise BadRequest('Invalid since date: {}'.format(since))
 
-        if website.default_lang_id:
-            lang_code = website.default_lang_id.code
-            domain = [('website_slug', '!=', False)]
+        # Only the records shared by all the websites or belonging to the current one
+        condition = SQL("%s AND (website_id IS NULL OR website_id = %s)", condition, website.id)
 
-            for category in request.env['product.public.category'].sudo().search(domain):
-                category = category.with_context(lang=lang_code)
-                categories.append(category.website_slug)
+        batches = []
+        if website.default_lang_id:
+            batches = iter_slug_batches(request.env.registry, table, website.default_lang_id.code, condition, since)
 
+        ndjson = output_format == 'ndjson'
         return Response(
-            json.dumps(categories),
-            headers={'Content-Type': 'application/json'},
+            stream_json(batches, to_item, ndjson),
+            headers={'Content-Type': 'application/x-ndjson' if ndjson else 'application/json'},
         )
 
-    @http.route(['/alokai/products', '/vsf/products'], type='http', auth='public', csrf=False)
-    def alokai_products(self):
-        self._set_website_context()
-        website = request.env['website'].get_current_website()
-
-        products = []
-
-        if website.default_lang_id:
-            lang_code = website.default_lang_id.code
-            domain = [('website_published', '=', True), ('website_slug', '!=', False)]
-
-            for product in request.env['product.template'].sudo().search(domain):
-                product = product.with_context(lang=lang_code)
-
-                url_parsed = urlparse(product.website_slug)
-                name = os.path.basename(url_parsed.path)
-                path = product.website_slug.replace(name, '')
-
-                products.append({
-                    'name': name,
-                    'path': '{}:slug'.format(path),
-                })
+    @http.route(['/alokai/categories', '/vsf/categories'], type='http', auth='public', csrf=False)
+    def alokai_categories(self, since=None, **kwargs):
+        return self._get_sitemap_response(
+            'product_public_category', SQL("TRUE"), since=since, output_format=kwargs.get('format'))
 
-        return Response(
-            json.dumps(products),
-            headers={'Content-Type': 'application/json'},
-        )
+    @http.route(['/alokai/products', '/vsf/products'], type='http', auth='public', csrf=False)
+    def alokai_products(self, since=None, **kwargs):
+        return self._get_sitemap_response(
+            'product_template', SQL("is_published AND active"), to_item=get_product_route, since=since,
+            output_format=kwargs.get('format'))
 
     @http.route(['/alokai/redirects', '/vsf/redirects'], type='http', auth='public', csrf=False)
     def alokai_redirects(self):
+        self._set_website_context()
+        website = request.env['website'].get_current_website()
+
         redirects = []
 
-        for redirect in request.env['website.rewrite'].sudo().search([]):
+        for redirect in request.env['website.rewrite'].sudo().search([('website_id', 'in', [False, website.id])]):
             redirects.append({
                 'from': redirect.url_from,
                 'to': redirect.url_to,
@@ -199,3 +358,54 @@ class GraphQLController(http.Controller, GraphQLControllerMixin):
             json.dumps(redirects),
             headers={'Content-Type': 'application/json'},
         )
+
+    def _get_gzip_json_response(self, data, etag, last_modified=None):
+        """ Serve gzip compressed JSON, decompressed for the clients not accepting gzip """
+        response = Response(headers={'Content-Type': 'application/json'})
+        if 'gzip' in request.httprequest.accept_encodings:
+            response.set_data(data)
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response.set_data(gzip.decompress(data))
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.vary.add('Accept-Encoding')
+        response.cache_control.no_cache = True
+        return response.make_conditional(request.httprequest)
+
+    @http.route(['/alokai/manifest', '/vsf/manifest'], type='http', auth='public', csrf=False)
+    def alokai_manifest(self, since=None, lang=None, **kwargs):
+        """
+        Route manifest of the website, in the website default language or the requested one.
+        With a since version, only the routes changed after that version, with null for the removed ones, or a
+        410 when the changes since that version are purged and the full manifest must be fetched again.
+        """
+        self._set_website_context()
+        website = request.env['website'].get_current_website()
+        lang = lang or website.default_lang_id.code
+        if not lang or lang not in website.language_ids.mapped('code'):
+            raise BadRequest('Invalid lang: {}'.format(lang))
+
+        RouteManifest = request.env['alokai.route.manifest'].sudo()
+        version = request.env['alokai.route.change'].sudo()._get_version()
+
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                raise BadRequest('Invalid since version: {}'.format(since))
+            etag = f'{website.id}-{lang}-{since}-{version}'
+            if etag in request.httprequest.if_none_match:
+                return Response(status=304, headers={'ETag': f'"{etag}"'})
+            delta = RouteManifest._get_delta(website, lang, since)
+            if delta is None:
+                return Response(status=410)
+            data = gzip.compress(json.dumps(delta, separators=(',', ':')).encode())
+            return self._get_gzip_json_response(data, etag)
+
+        # The version is known before the manifest is loaded, a conditional request does not read it
+        etag = f'{website.id}-{lang}-{version}'
+        if etag in request.httprequest.if_none_match:
+            return Response(status=304, headers={'ETag': f'"{etag}"'})
+        data, version, last_modified = RouteManifest._get_manifest(website, lang)
+        return self._get_gzip_json_response(data, f'{website.id}-{lang}-{version}', last_modified)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from graphql import parse, validate, GraphQLError
+
+from odoo.tools import config
+
+_logger = logging.getLogger(__name__)
+
+PERSISTED_QUERY_CACHE_SIZE = 512
+# Bounds of the filestore store, the queries are registered by anonymous clients
+PERSISTED_QUERY_MAX_SIZE = 64 * 1024
+PERSISTED_QUERY_MAX_COUNT = 2000
+PERSISTED_QUERY_HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+class PersistedQueryCache(object):
+    """
+    Process wide LRU of parsed and validated GraphQL documents, keyed by the sha256 hash of the query.
+    Parsing and validating only depends on the query and the schema, so a cached document can be executed as is.
+    """
+
+    def __init__(self, max_size=PERSISTED_QUERY_CACHE_SIZE):
+        self.max_size = max_size
+        self._documents = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, query_hash):
+        with self._lock:
+            document = self._documents.get(query_hash)
+            if document is not None:
+                self._documents.move_to_end(query_hash)
+            return document
+
+    def set(self, query_hash, document):
+        with self._lock:
+            self._documents[query_hash] = document
+            self._documents.move_to_end(query_hash)
+            while len(self._documents) > self.max_size:
+                self._documents.popitem(last=False)
+
+
+persisted_query_cache = PersistedQueryCache()
+
+
+def get_query_hash(query):
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+def is_query_hash(query_hash):
+    return isinstance(query_hash, str) and bool(PERSISTED_QUERY_HASH_RE.match(query_hash))
+
+
+def parse_and_validate(schema, query):
+    """ Return the parsed document and the list of validation errors """
+    try:
+        document = parse(query)
+    except GraphQLError as error:
+        return None, [error]
+    return document, validate(schema, document)
+
+
+def _get_store_path(dbname):
+    return os.path.join(config.filestore(dbname), 'alokai_persisted_queries')
+
+
+def _get_query_path(dbname, query_hash):
+    return os.path.join(_get_store_path(dbname), query_hash[:2], query_hash)
+
+
+def _count_persisted_queries(dbname):
+    count = 0
+    try:
+        with os.scandir(_get_store_path(dbname)) as directories:
+            for directory in directories:
+                if directory.is_dir():
+                    count += sum(1 for entry in os.scandir(directory.path) if not entry.name.endswith('.tmp'))
+    except OSError:
+        pass
+    return count
+
+
+def load_persisted_query(dbname, query_hash):
+    """ Read a persisted query from the filestore, so all workers share the queries registered by the clients """
+    if not is_query_hash(query_hash):
+        return None
+    try:
+        with open(_get_query_path(dbname, query_hash), 'r', encoding='utf-8') as query_file:
+            return query_file.read()
+    except OSError:
+        return None
+
+
+def save_persisted_query(dbname, query_hash, query):
+    """
+    Persist a query on the filestore, unless it is too large or the store is full. A query which is not persisted
+    is still answered from the LRU of the worker, or sent again by the client after a PersistedQueryNotFound.
+    """
+    if not is_query_hash(query_hash) or len(query) > PERSISTED_QUERY_MAX_SIZE:
+        return
+    path = _get_query_path(dbname, query_hash)
+    if os.path.exists(path):
+        return
+    if _count_persisted_queries(dbname) >= PERSISTED_QUERY_MAX_COUNT:
+        _logger.warning('GraphQL persisted query store is full, query %s is not persisted', query_hash)
+        return
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as query_file:
+            query_file.write(query)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        _logger.warning('Unable to persist GraphQL query %s: %s', query_hash, e)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+from graphql import get_operation_ast, OperationType
+from graphql.language import FieldNode
+
+from odoo import models
+
+# Root fields returning the same data to every public visitor of a website, language and pricelist
+CACHEABLE_ROOT_FIELDS = {
+    '__typename', 'products', 'product', 'categories', 'websiteMenu', 'websiteHomepage', 'blogPosts', 'websitePages',
+}
+
+# Fields depending on the visitor session
+UNCACHEABLE_FIELDS = {'isInWishlist'}
+
+
+def _get_field_names(node, names):
+    selection_set = getattr(node, 'selection_set', None)
+    if selection_set:
+        for selection in selection_set.selections:
+            if isinstance(selection, FieldNode):
+                names.add(selection.name.value)
+            _get_field_names(selection, names)
+    return names
+
+
+def is_cacheable_document(document, operation_name):
+    """ A query is cacheable when all of its root fields are catalog fields and it selects no session field """
+    operation = get_operation_ast(document, operation_name)
+    if not operation or operation.operation != OperationType.QUERY:
+        return False
+
+    root_selections = operation.selection_set.selections
+    if not all(isinstance(s, FieldNode) and s.name.value in CACHEABLE_ROOT_FIELDS for s in root_selections):
+        return False
+
+    field_names = set()
+    for definition in document.definitions:
+        _get_field_names(definition, field_names)
+    return not field_names & UNCACHEABLE_FIELDS
+
+
+class CacheTagMiddleware(object):
+    """ Collect the cache tags of the records resolved while executing a query """
+
+    def __init__(self):
+        self.tags = set()
+
+    def _add_tags(self, records):
+        if records._name == 'product.template':
+            self.tags.update(f'P{record_id}' for record_id in records.ids)
+        elif records._name == 'product.product':
+            self.tags.update(f'P{product.product_tmpl_id.id}' for product in records)
+        elif records._name == 'product.public.category':
+            self.tags.update(f'C{record_id}' for record_id in records.ids)
+        elif records._name == 'website.rewrite':
+            self.tags.update(f'WR{record_id}' for record_id in records.ids)
+
+    def _add_filter_tags(self, info, kwargs):
+        """ A product list also depends on the categories it is filtered on, e.g. a product added to the category """
+        product_filter = kwargs.get('filter') or {}
+        if product_filter.get('category_id'):
+            self.tags.update(f'C{category_id}' for category_id in product_filter['category_id'])
+        elif product_filter.get('category_slug'):
+            env = info.context['env']
+            categories = env['product.public.category'].search(
+                [('website_slug', '=', product_filter['category_slug'])], limit=1)
+            self._add_tags(categories)
+
+    def resolve(self, next, root, info, **kwargs):
+        if isinstance(root, models.BaseModel):
+            self._add_tags(root)
+        elif root is None and info.field_name == 'products':
+            self._add_filter_tags(info, kwargs)
+        return next(root, info, **kwargs)
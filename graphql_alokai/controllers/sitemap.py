@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import json
+
+from odoo.tools import SQL
+
+SITEMAP_BATCH_SIZE = 5000
+
+
+def iter_slug_batches(registry, table, lang, condition, since=None, batch_size=SITEMAP_BATCH_SIZE):
+    """
+    Yield the website slugs of the table in the language, by batches of ids read in the id order.
+    The response is streamed after the request cursor is closed, so the batches are read on a cursor of their own.
+    """
+    since_condition = SQL("write_date >= %s", since) if since else SQL("TRUE")
+    with registry.cursor() as cr:
+        last_id = 0
+        while True:
+            cr.execute(SQL("""
+                SELECT id, COALESCE(website_slug->>%(lang)s, website_slug->>'en_US')
+                FROM %(table)s
+                WHERE id > %(last_id)s AND website_slug IS NOT NULL AND %(condition)s AND %(since_condition)s
+                ORDER BY id
+                LIMIT %(limit)s
+            """, lang=lang, table=SQL.identifier(table), last_id=last_id, condition=condition,
+                since_condition=since_condition, limit=batch_size))
+            rows = cr.fetchall()
+            slugs = [slug for __, slug in rows if slug]
+            if slugs:
+                yield slugs
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+
+
+def get_product_route(slug):
+    """ Split /product/<name>-<id> into the route name and its path pattern """
+    path, __, name = slug.rpartition('/')
+    return {
+        'name': name,
+        'path': '{}/:slug'.format(path),
+    }
+
+
+def stream_json(batches, to_item=None, ndjson=False):
+    """ Serialize the batches as a JSON array, or as newline delimited JSON, one chunk per batch """
+    if not ndjson:
+        yield '['
+    separator = ''
+    for batch in batches:
+        items = [json.dumps(to_item(value) if to_item else value) for value in batch]
+        if ndjson:
+            yield ''.join(f'{item}\n' for item in items)
+        else:
+            yield separator + ','.join(items)
+            separator = ','
+    if not ndjson:
+        yield ']'
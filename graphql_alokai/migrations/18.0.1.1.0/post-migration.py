@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import logging
+
+from odoo import api, SUPERUSER_ID
+from odoo.exceptions import UserError
+from redis.exceptions import RedisError
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    """ The dirty stock products are tracked in a single Redis set, drop the legacy per product keys """
+    if not version:
+        return
+
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    try:
+        env['product.product']._migrate_legacy_stock_dirty_redis()
+    except (UserError, RedisError) as e:
+        _logger.warning('Legacy dirty stock keys not migrated: %s', e)
@@ -2,13 +2,17 @@
 # Copyright 2024 ERPGAP/PROMPTEQUATION LDA
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
 
+from . import alokai_settings
 from . import invalidate_cache
+from . import graphql_cache
 from . import website
 from . import product
 from . import res_config_settings
 from . import res_users
 from . import payment_transaction
 from . import ir_binary
+from . import image_derivative
+from . import route_manifest
 from . import sale_order
 from . import alokai_website_page
 from . import stock
\ No newline at end of file
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import ast
+
+from odoo import api, models, tools
+
+
+def _to_bool(value, default):
+    if value is None:
+        return default
+    return value not in ('', 'False', 'false', '0')
+
+
+def _to_int(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _to_str(value, default):
+    return value if value is not None else default
+
+
+def _to_int_list(value, default):
+    if value is None:
+        return default
+    try:
+        return tuple(sorted(int(item) for item in value.split(',') if item.strip()))
+    except ValueError:
+        return default
+
+
+def _to_size_list(value, default):
+    """ Parse comma separated <width>x<height> sizes, a 0 dimension follows the aspect ratio of the source """
+    if value is None:
+        return default
+    try:
+        return tuple(tuple(int(side) for side in size.strip().split('x', 1)) for size in value.split(',')
+                     if size.strip())
+    except ValueError:
+        return default
+
+
+def _to_str_list(value, default):
+    if value is None:
+        return default
+    return tuple(item.strip() for item in value.split(',') if item.strip())
+
+
+def _to_rgba(value, default):
+    if value is None:
+        return default
+    try:
+        rgba = tuple(int(channel) for channel in ast.literal_eval(value))
+    except (ValueError, TypeError, SyntaxError):
+        return (66, 28, 82)
+    return rgba if len(rgba) in (3, 4) else (66, 28, 82)
+
+
+# Parameter key: (converter, default value)
+ALOKAI_SETTINGS = {
+    'alokai_debug_mode': (_to_bool, False),
+    'alokai_cache_invalidation': (_to_bool, False),
+    'alokai_cache_invalidation_key': (_to_str, False),
+    'alokai_cache_invalidation_url': (_to_str, False),
+    'alokai_image_quality': (_to_int, 100),
+    'alokai_image_quality_avif': (_to_int, 60),
+    'alokai_image_quality_jpeg': (_to_int, 85),
+    'alokai_image_breakpoints': (_to_int_list, (128, 256, 512, 1024, 1920)),
+    'alokai_image_background_rgba': (_to_rgba, (255, 255, 255, 255)),
+    'alokai_image_pregenerate_sizes': (_to_size_list, ((512, 512), (1024, 1024))),
+    'alokai_image_pregenerate_formats': (_to_str_list, ('webp',)),
+    'alokai_image_resize_limit': (_to_int, 1920),
+    'alokai_recent_sales_count_days': (_to_int, 30),
+    'alokai_redis_host': (_to_str, False),
+    'alokai_redis_port': (_to_int, False),
+    'alokai_redis_db': (_to_int, 0),
+    'alokai_redis_unix_socket': (_to_str, False),
+    'alokai_graphql_cache': (_to_bool, False),
+    'alokai_graphql_cache_ttl': (_to_int, 300),
+    'web.base.url': (_to_str, ''),
+}
+
+
+class AlokaiSettings(models.AbstractModel):
+    """
+    Typed snapshot of the Alokai system parameters, loaded with a single query and kept in the registry cache.
+    Writing a system parameter clears the registry cache, so the snapshot is reloaded after the settings are saved.
+    """
+    _name = 'alokai.settings'
+    _description = 'Alokai Settings'
+
+    @api.model
+    @tools.ormcache()
+    def _get_settings(self):
+        self.env.cr.execute(
+            "SELECT key, value FROM ir_config_parameter WHERE key IN %s",
+            [tuple(ALOKAI_SETTINGS)],
+        )
+        params = dict(self.env.cr.fetchall())
+        return tools.frozendict({
+            key: converter(params.get(key), default)
+            for key, (converter, default) in ALOKAI_SETTINGS.items()
+        })
+
+    @api.model
+    def get(self, key):
+        return self._get_settings()[key]
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import hashlib
+import json
+import logging
+
+from odoo import api, models
+from odoo.exceptions import UserError
+from redis.exceptions import RedisError
+
+from .website import redis_circuit_breaker
+
+_logger = logging.getLogger(__name__)
+
+
+class AlokaiGraphqlCache(models.AbstractModel):
+    """
+    Full response cache of the GraphQL queries executed by the website public user.
+    The responses are stored on Redis and every response key is added to the sets of the cache tags (P<id>, C<id>,
+    WR<id>) of the records it contains, so the invalidation of a tag only purges the affected responses.
+
+    The keys are namespaced by website and by a generation counter of the website: flushing the cache of a website
+    increments its generation, which makes all its entries unreachable at once. The entries of the previous
+    generations expire or are removed by the Redis sweeper cron.
+    """
+    _name = 'alokai.graphql.cache'
+    _description = 'Alokai GraphQL Response Cache'
+
+    _generation_prefix = 'alokai:gen:'
+    _key_prefix = 'alokai:cache:'
+    _tag_prefix = 'alokai:tag:'
+
+    @api.model
+    def _is_enabled(self):
+        return self.env['alokai.settings'].get('alokai_graphql_cache')
+
+    @api.model
+    def _get_ttl(self):
+        return self.env['alokai.settings'].get('alokai_graphql_cache_ttl')
+
+    @api.model
+    def _get_generations(self, redis_client, website_ids):
+        """ Return {website id: current cache generation} """
+        generations = redis_client.mget([f'{self._generation_prefix}{website_id}' for website_id in website_ids])
+        return {website_id: int(generation or 0) for website_id, generation in zip(website_ids, generations)}
+
+    @api.model
+    def _get_keep_prefixes(self, redis_client):
+        """ Return the prefixes of the keys of the current generations, and of the generation counters """
+        website_ids = self.env['website'].sudo().search([]).ids
+        prefixes = [self._generation_prefix]
+        for website_id, generation in self._get_generations(redis_client, website_ids).items():
+            prefixes.append(f'{self._key_prefix}{website_id}:{generation}:')
+            prefixes.append(f'{self._tag_prefix}{website_id}:{generation}:')
+        return prefixes
+
+    @api.model
+    def _get_key(self, query_hash, operation_name, variables, website_id, lang, pricelist_id):
+        """ Return the cache key of the response in the current generation of the website, None if Redis fails """
+        key = json.dumps([query_hash, operation_name, variables, website_id, lang, pricelist_id], sort_keys=True)
+        try:
+            redis_client = self.env['website']._redis_connect()
+            generation = self._get_generations(redis_client, [website_id])[website_id]
+        except RedisError as e:
+            redis_circuit_breaker.record_failure()
+            _logger.warning('GraphQL cache unavailable: %s', e)
+            return None
+        except UserError as e:
+            _logger.warning('GraphQL cache unavailable: %s', e)
+            return None
+        return f'{self._key_prefix}{website_id}:{generation}:{hashlib.sha256(key.encode()).hexdigest()}'
+
+    @api.model
+    def _get(self, key):
+        try:
+            value = self.env['website']._redis_connect().get(key)
+            redis_circuit_breaker.record_success()
+            return value
+        except RedisError as e:
+            redis_circuit_breaker.record_failure()
+            _logger.warning('GraphQL cache unavailable: %s', e)
+        except UserError as e:
+            _logger.warning('GraphQL cache unavailable: %s', e)
+        return None
+
+    @api.model
+    def _set(self, key, body, tags):
+        ttl = self._get_ttl()
+        # The tag sets live in the namespace of the key, alokai:tag:<website id>:<generation>:<tag>
+        namespace = key[len(self._key_prefix):].rsplit(':', 1)[0]
+        try:
+            pipe = self.env['website']._redis_connect().pipeline(transaction=False)
+            pipe.set(key, body, ex=ttl)
+            for tag in tags:
+                tag_key = f'{self._tag_prefix}{namespace}:{tag}'
+                pipe.sadd(tag_key, key)
+                pipe.expire(tag_key, ttl)
+            pipe.execute()
+        except (UserError, RedisError) as e:
+            _logger.warning('GraphQL cache unavailable: %s', e)
+
+    @api.model
+    def _purge_tags(self, tags):
+        """ Delete the cached responses containing any of the tags, in the current generation of every website """
+        tags = [tag for tag in tags if tag]
+        if not tags or not self._is_enabled():
+            return
+
+        try:
+            redis_client = self.env['website']._redis_connect()
+            website_ids = self.env['website'].sudo().search([]).ids
+            tag_keys = [
+                f'{self._tag_prefix}{website_id}:{generation}:{tag}'
+                for website_id, generation in self._get_generations(redis_client, website_ids).items()
+                for tag in tags
+            ]
+
+            pipe = redis_client.pipeline(transaction=False)
+            for tag_key in tag_keys:
+                pipe.smembers(tag_key)
+            keys = set().union(*pipe.execute())
+            keys.update(tag_keys)
+            redis_client.unlink(*keys)
+        except (UserError, RedisError) as e:
+            _logger.warning('GraphQL cache unavailable: %s', e)
+
+    @api.model
+    def _flush(self, website_ids):
+        """ Make the cached responses of the websites unreachable, in O(1) per website """
+        redis_client = self.env['website']._redis_connect()
+        pipe = redis_client.pipeline(transaction=False)
+        for website_id in website_ids:
+            pipe.incr(f'{self._generation_prefix}{website_id}')
+        pipe.execute()
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from odoo import api, fields, models
+from odoo.exceptions import UserError
+
+from .ir_binary import (
+    IMAGE_FORMATS, RENDERED_MIMETYPES, decode_image, gc_image_derivatives, get_supported_image_formats,
+    load_image_derivative, render_decoded_image, save_image_derivative, snap_image_size
+)
+
+_logger = logging.getLogger(__name__)
+
+# Image fields rendered by the storefront: (field of the stored attachment, field requested by the storefront)
+IMAGE_DERIVATIVE_FIELDS = {
+    'product.template': ('image_1920', 'image_1920'),
+    'product.product': ('image_variant_1920', 'image_1920'),
+    'product.image': ('image_1920', 'image_1920'),
+    'cms.image': ('image_1920', 'image_1920'),
+}
+IMAGE_DERIVATIVE_QUEUE_LIMIT = 20
+IMAGE_DERIVATIVE_MAX_RETRIES = 3
+
+
+def render_image_derivatives(data, derivatives):
+    """
+    Render the derivatives of a source image, decoded once at the largest size, only from bytes so it can run in the
+    worker threads
+    """
+    draft_size = max(max(derivative[1], derivative[2]) for derivative in derivatives)
+    image = decode_image(data, (draft_size, draft_size))
+    return [
+        (key, render_decoded_image(image, width, height, crop, background_rgba, quality, image_format))
+        for key, width, height, crop, background_rgba, quality, image_format in derivatives
+    ]
+
+
+class AlokaiImageQueue(models.Model):
+    """ Images whose derivatives must be rendered, at the pre-generated sizes and formats of the settings """
+    _name = 'alokai.image.queue'
+    _description = 'Alokai Image Derivative Queue'
+
+    res_model = fields.Char('Res Model', required=True)
+    res_id = fields.Integer('Res ID', required=True)
+    res_field = fields.Char('Res Field', required=True)
+    retry_count = fields.Integer('Retry Count', default=0, required=True)
+
+    def init(self):
+        super().init()
+        self.env.cr.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS alokai_image_queue_res_uniq
+            ON alokai_image_queue(res_model, res_id, res_field);
+        """)
+
+    @api.model
+    def _enqueue(self, images):
+        """ Queue the (res model, res id, res field) images """
+        if not images:
+            return
+        res_models, res_ids, res_fields = zip(*images)
+        self.env.cr.execute("""
+            INSERT INTO alokai_image_queue(res_model, res_id, res_field, create_date, write_date, create_uid, write_uid)
+            SELECT image.res_model, image.res_id, image.res_field,
+                   NOW() AT TIME ZONE 'UTC', NOW() AT TIME ZONE 'UTC', %s, %s
+            FROM unnest(%s::varchar[], %s::int[], %s::varchar[]) AS image(res_model, res_id, res_field)
+            ON CONFLICT (res_model, res_id, res_field) DO NOTHING;
+        """, (self.env.uid, self.env.uid, list(res_models), list(res_ids), list(res_fields)))
+
+    def _get_derivatives(self, record):
+        """ Return the source data and the (key, width, height, crop, background, quality, format) to render """
+        IrBinary = self.env['ir.binary']
+        try:
+            source = IrBinary._get_stream_from(record, self.res_field)
+        except UserError:
+            return None, []
+        if not source or not source.etag or source.mimetype not in RENDERED_MIMETYPES:
+            return None, []
+
+        # The configured sizes are snapped as the image route does, so the derivatives are the ones it serves
+        settings = self.env['alokai.settings']
+        breakpoints = settings.get('alokai_image_breakpoints')
+        image_formats = [image_format for image_format in settings.get('alokai_image_pregenerate_formats')
+                         if image_format in get_supported_image_formats()]
+        background_rgba = IrBinary._get_image_background_rgba()
+        derivatives = []
+        for width, height in settings.get('alokai_image_pregenerate_sizes'):
+            if not width and not height:
+                continue
+            width, height = snap_image_size(width, height, breakpoints)
+            for image_format in image_formats:
+                key = IrBinary._compute_image_derivative_key(source.etag, width, height, False, image_format)
+                if not load_image_derivative(self.env.cr.dbname, key):
+                    quality = settings.get(IMAGE_FORMATS[image_format][2])
+                    derivatives.append((key, width, height, False, background_rgba, quality, image_format))
+
+        if not derivatives:
+            return None, []
+        return source.data or source.read(), derivatives
+
+    @api.model
+    def _generate_image_derivatives(self, limit=IMAGE_DERIVATIVE_QUEUE_LIMIT):
+        """
+        Render the derivatives of the queued images in a pool of threads, Pillow releases the GIL while decoding,
+        resizing and encoding so the rendering uses all cores. The threads only run the pure rendering from bytes, the
+        records are read and the files written by the cron. The images failing to render are retried by the next runs.
+        """
+        images = self.search([], order='retry_count, id', limit=limit)
+        if not images:
+            return
+
+        jobs = []
+        for image in images:
+            record = self.env[image.res_model].sudo().browse(image.res_id).exists() \
+                if image.res_model in self.env else None
+            if record:
+                data, derivatives = image._get_derivatives(record)
+                if derivatives:
+                    jobs.append((image, data, derivatives))
+
+        # Each image is committed as soon as its derivatives are saved, so a run stopped by the time limit keeps them
+        done = images - self.browse([image.id for image, __, __ in jobs])
+        done.unlink()
+        self.env.cr.commit()
+
+        if jobs:
+            dbname = self.env.cr.dbname
+            with ThreadPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1)) as pool:
+                futures = [(image, pool.submit(render_image_derivatives, data, derivatives))
+                           for image, data, derivatives in jobs]
+                for image, future in futures:
+                    try:
+                        for key, data in future.result():
+                            save_image_derivative(dbname, key, data)
+                    except Exception as e:
+                        _logger.warning('Unable to render image derivatives of %s,%s: %s',
+                                        image.res_model, image.res_id, e)
+                        if image.retry_count + 1 < IMAGE_DERIVATIVE_MAX_RETRIES:
+                            image.retry_count += 1
+                        else:
+                            image.unlink()
+                    else:
+                        image.unlink()
+                    self.env.cr.commit()
+
+        if len(images) == limit:
+            self.env.ref('graphql_alokai.ir_cron_generate_image_derivatives')._trigger()
+
+    @api.model
+    def _gc_image_derivatives(self):
+        deleted = gc_image_derivatives(self.env.cr.dbname)
+        _logger.info('Deleted %s unused image derivatives', deleted)
+
+
+class IrAttachment(models.Model):
+    _inherit = 'ir.attachment'
+
+    def _enqueue_image_derivatives(self):
+        images = []
+        for attachment in self:
+            stored_field, served_field = IMAGE_DERIVATIVE_FIELDS.get(attachment.res_model, (None, None))
+            if attachment.res_id and stored_field and stored_field == attachment.res_field:
+                images.append((attachment.res_model, attachment.res_id, served_field))
+        self.env['alokai.image.queue'].sudo()._enqueue(images)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        attachments = super(IrAttachment, self).create(vals_list)
+        attachments._enqueue_image_derivatives()
+        return attachments
+
+    def write(self, vals):
+        res = super(IrAttachment, self).write(vals)
+        if {'raw', 'datas', 'db_datas'} & set(vals):
+            self._enqueue_image_derivatives()
+        return res
@@ -3,13 +3,49 @@
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
 
 import logging
-from datetime import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from odoo import models, fields, api
 
 _logger = logging.getLogger(__name__)
 
+# Queue rows processed per run, and maximum length of the tags of a single purge request
+INVALIDATION_QUEUE_LIMIT = 10000
+INVALIDATION_TAGS_MAX_LENGTH = 2000
+INVALIDATION_WORKERS = 4
+
+
+def split_tags(tags, max_length=INVALIDATION_TAGS_MAX_LENGTH):
+    """ Split the tags into comma separated strings of at most max_length characters """
+    batch, length = [], 0
+    for tag in tags:
+        if batch and length + len(tag) + 1 > max_length:
+            yield ','.join(batch)
+            batch, length = [], 0
+        batch.append(tag)
+        length += len(tag) + 1
+    if batch:
+        yield ','.join(batch)
+
+
+def get_invalidation_session():
+    """ HTTP session keeping the connections to the storefront alive, retrying the failed purges with a backoff """
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['GET']),
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=INVALIDATION_WORKERS)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
 
 class InvalidateCache(models.Model):
     _name = 'invalidate.cache'
@@ -20,106 +56,161 @@ class InvalidateCache(models.Model):
 
     def init(self):
         super().init()
-        self.env.cr.execute("""
-            CREATE INDEX IF NOT EXISTS invalidate_cache_find_idx
-            ON invalidate_cache(res_model, res_id);
-        """)
-
-    @api.model
-    def find_invalidate_cache(self, res_model, res_id):
         cr = self.env.cr
-        query = """
-            SELECT id
-            FROM invalidate_cache
-            WHERE res_model=%s AND res_id=%s
-            LIMIT 1;
-        """
-        params = (res_model, res_id,)
 
-        cr.execute(query, params)
-        return cr.fetchone()
+        # The queue holds each record once, remove the duplicates left by the previous non unique index
+        cr.execute("""
+            DELETE FROM invalidate_cache a
+            USING invalidate_cache b
+            WHERE a.res_model = b.res_model AND a.res_id = b.res_id AND a.id > b.id;
+        """)
+        cr.execute("DROP INDEX IF EXISTS invalidate_cache_find_idx;")
+        cr.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS invalidate_cache_res_uniq
+            ON invalidate_cache(res_model, res_id);
+        """)
 
     @api.model
     def create_invalidate_cache(self, res_model, res_ids):
-        ICP = self.env['ir.config_parameter'].sudo()
-        cache_invalidation_enable = ICP.get_param('alokai_cache_invalidation', False)
+        cache_invalidation_enable = self.env['alokai.settings'].get('alokai_cache_invalidation')
 
-        if not cache_invalidation_enable:
+        if not cache_invalidation_enable or not res_ids:
             return False
 
-        for res_id in res_ids:
-            if not self.find_invalidate_cache(res_model, res_id):
-                query = """
-                    INSERT INTO invalidate_cache(res_model, res_id, create_date, write_date, create_uid, write_uid)
-                    VALUES(%s, %s, %s, %s, %s, %s);
-                """
-                now = datetime.now()
-                uid = self.env.user.id
-                params = (res_model, res_id, now, now, uid, uid,)
+        # The write date of a queued record is bumped on every write, so the cron only dequeues the rows that were
+        # not written again while their purge was sent. It is taken from the clock of the statement, after the lock
+        # of a conflicting row is acquired, so it always increases.
+        uid = self.env.user.id
+        query = """
+            INSERT INTO invalidate_cache(res_model, res_id, create_date, write_date, create_uid, write_uid)
+            SELECT %s, res_id, NOW() AT TIME ZONE 'UTC', clock_timestamp() AT TIME ZONE 'UTC', %s, %s
+            FROM unnest(%s::int[]) AS res_id
+            ON CONFLICT (res_model, res_id) DO UPDATE
+            SET write_date = clock_timestamp() AT TIME ZONE 'UTC', write_uid = EXCLUDED.write_uid;
+        """
+        params = (res_model, uid, uid, list(res_ids),)
 
-                self.env.cr.execute(query, params)
+        self.env.cr.execute(query, params)
+        return True
 
     @api.model
-    def delete_invalidate_cache(self, ids):
-        if len(ids) == 1:
-            ids = '({})'.format(ids[0])
-        else:
-            ids = tuple(ids)
+    def delete_invalidate_cache(self, ids, write_dates=None):
+        """ Delete the rows, only those not written since the given write dates {row id: write date} if any """
+        if not ids:
+            return
+
+        if write_dates is None:
+            self.env.cr.execute("DELETE FROM invalidate_cache WHERE id = ANY(%s);", (list(ids),))
+            return
 
+        ids = list(ids)
         query = """
             DELETE FROM invalidate_cache
-            WHERE id IN {};
-        """.format(ids)
+            USING unnest(%s::int[], %s::timestamp[]) AS dequeued(id, write_date)
+            WHERE invalidate_cache.id = dequeued.id AND invalidate_cache.write_date <= dequeued.write_date;
+        """
+
+        self.env.cr.execute(query, (ids, [write_dates[row_id] for row_id in ids]))
 
-        self.env.cr.execute(query)
+    @api.model
+    def _get_write_dates(self, ids):
+        self.env.cr.execute("SELECT id, write_date FROM invalidate_cache WHERE id = ANY(%s)", (list(ids),))
+        return dict(self.env.cr.fetchall())
+
+    @api.model
+    def _get_invalidation_tags(self, limit=INVALIDATION_QUEUE_LIMIT):
+        """
+        Expand the queued records into the cache tags they affect, with one query for the whole queue.
+        A product affects its page (P) and the pages of its categories (C), a category affects its page, the pages of
+        its parent and children and the pages of its products, a redirect affects the pages it was served on (WR).
+        Return a list of (queue row id, tag).
+        """
+        self.env.cr.execute("""
+            WITH queue AS (
+                SELECT id, res_model, res_id
+                FROM invalidate_cache
+                WHERE res_model IN ('product.template', 'product.public.category', 'website.rewrite')
+                ORDER BY id
+                LIMIT %(limit)s
+            )
+            SELECT queue.id, 'P' || queue.res_id
+            FROM queue
+            WHERE queue.res_model = 'product.template'
+            UNION ALL
+            SELECT queue.id, 'C' || rel.product_public_category_id
+            FROM queue
+            JOIN product_template_product_public_category_slug_rel rel ON rel.product_template_id = queue.res_id
+            WHERE queue.res_model = 'product.template'
+            UNION ALL
+            SELECT queue.id, 'C' || queue.res_id
+            FROM queue
+            WHERE queue.res_model = 'product.public.category'
+            UNION ALL
+            SELECT queue.id, 'C' || category.id
+            FROM queue
+            JOIN product_public_category category
+                ON category.parent_id = queue.res_id
+                OR category.id = (SELECT parent_id FROM product_public_category WHERE id = queue.res_id)
+            WHERE queue.res_model = 'product.public.category'
+            UNION ALL
+            SELECT queue.id, 'P' || rel.product_template_id
+            FROM queue
+            JOIN product_template_product_public_category_slug_rel rel ON rel.product_public_category_id = queue.res_id
+            WHERE queue.res_model = 'product.public.category'
+            UNION ALL
+            SELECT queue.id, 'WR' || queue.res_id
+            FROM queue
+            WHERE queue.res_model = 'website.rewrite'
+        """, {'limit': limit})
+        return self.env.cr.fetchall()
 
     @api.model
-    def request_cache_invalidation(self, url, key, tags):
-        if url and key and tags:
+    def _dispatch_cache_invalidation(self, url, key, tags):
+        """ Send the purge requests of the tags concurrently and return the tags that were not acknowledged """
+        session = get_invalidation_session()
+
+        def send(tags):
             try:
-                requests.get(url, params={'key': key, 'tags': tags}, timeout=5)
-            except Exception as e:
-                _logger.error(e)
-                self.env.cr.rollback()
+                response = session.get(url, params={'key': key, 'tags': tags}, timeout=5)
+                response.raise_for_status()
+                return True
+            except requests.RequestException as e:
+                _logger.error('Cache invalidation request failed: %s', e)
+                return False
+
+        purge_requests = list(split_tags(tags))
+
+        with session, ThreadPoolExecutor(max_workers=INVALIDATION_WORKERS) as executor:
+            results = list(executor.map(send, purge_requests))
+
+        return {tag for tags, sent in zip(purge_requests, results) if not sent for tag in tags.split(',')}
 
     @api.model
     def request_alokai_cache_invalidation(self):
-        ICP = self.env['ir.config_parameter'].sudo()
-        url = ICP.get_param('alokai_cache_invalidation_url', False)
-        key = ICP.get_param('alokai_cache_invalidation_key', False)
-
-        models = [
-            {
-                'name': 'product.template',
-                'tags_method': '_get_product_tags',
-            },
-            {
-                'name': 'product.public.category',
-                'tags_method': '_get_category_tags',
-            },
-        ]
-
-        for model in models:
-            invalidate_caches = self.env['invalidate.cache'].search([('res_model', '=', model['name'])])
-            if invalidate_caches:
-                res_ids = invalidate_caches.mapped('res_id')
-                tags = getattr(self, model['tags_method'])(res_ids)
-                self.delete_invalidate_cache(invalidate_caches.ids)
-                self.request_cache_invalidation(url, key, tags)
-                self.env.cr.commit()
-
-    def _get_product_tags(self, product_ids):
-        tags = ','.join(f'P{product_id}' for product_id in product_ids)
-        category_ids = self.env['product.template'].search(
-            [('id', 'in', product_ids)]).mapped('public_categ_slug_ids').ids
-        if category_ids:
-            tags += ',' + ','.join(f'C{category_id}' for category_id in category_ids)
-        return tags
-
-    def _get_category_tags(self, product_ids):
-        tags = ','.join(f'P{product_id}' for product_id in product_ids)
-        category_ids = self.env['product.template'].search(
-            [('id', 'in', product_ids)]).mapped('public_categ_slug_ids').ids
-        if category_ids:
-            tags += ',' + ','.join(f'C{category_id}' for category_id in category_ids)
-        return tags
+        settings = self.env['alokai.settings']
+        url = settings.get('alokai_cache_invalidation_url')
+        key = settings.get('alokai_cache_invalidation_key')
+
+        # Each tag is purged once, whatever the number of queued records affecting it
+        tag_row_ids = defaultdict(set)
+        for row_id, tag in self._get_invalidation_tags():
+            tag_row_ids[tag].add(row_id)
+
+        if not tag_row_ids:
+            return
+
+        tags = sorted(tag_row_ids)
+        row_ids = set().union(*tag_row_ids.values())
+        write_dates = self._get_write_dates(row_ids)
+        # End the snapshot the queue was read with, the rows written meanwhile are then seen by the dequeue
+        self.env.cr.commit()
+
+        self.env['alokai.graphql.cache']._purge_tags(tags)
+
+        # The rows of the failed purges stay in the queue for the next run
+        if url and key:
+            for tag in self._dispatch_cache_invalidation(url, key, tags):
+                row_ids -= tag_row_ids[tag]
+
+        self.delete_invalidate_cache(row_ids, write_dates)
+        self.env.cr.commit()
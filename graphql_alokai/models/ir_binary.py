@@ -1,17 +1,184 @@
 # -*- coding: utf-8 -*-
 # Copyright 2024 ODOOGAP/PROMPTEQUATION LDA
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
-import base64
+import hashlib
 import io
+import json
+import logging
+import os
+import threading
+import time
+from functools import lru_cache
 from mimetypes import guess_extension
-from PIL import Image, WebPImagePlugin
+from PIL import Image, ImageOps
 
-from odoo import models
-from odoo.http import request
+from odoo import models, _
+from odoo.exceptions import UserError
+from odoo.http import request, Stream
+from odoo.tools import config
 from odoo.tools.safe_eval import safe_eval
-from odoo.tools.image import image_process, image_guess_size_from_field_name
+from odoo.tools.image import image_fix_orientation, IMAGE_MAX_RESOLUTION
 from odoo.tools.mimetypes import guess_mimetype, get_extension
 
+_logger = logging.getLogger(__name__)
+
+# Bump to invalidate the cached image derivatives when the rendering changes
+IMAGE_DERIVATIVE_VERSION = 3
+# The derivatives not served for that many days are deleted, the date of a served derivative is refreshed daily
+IMAGE_DERIVATIVE_MAX_AGE_DAYS = 30
+IMAGE_DERIVATIVE_TOUCH_INTERVAL = 24 * 3600
+
+RENDERED_MIMETYPES = ('image/jpeg', 'image/jpg', 'image/png', 'image/webp', 'image/gif')
+
+# Output format: (PIL format, mimetype, quality setting), by order of preference
+IMAGE_FORMATS = {
+    'avif': ('AVIF', 'image/avif', 'alokai_image_quality_avif'),
+    'webp': ('WEBP', 'image/webp', 'alokai_image_quality'),
+    'jpeg': ('JPEG', 'image/jpeg', 'alokai_image_quality_jpeg'),
+}
+
+
+@lru_cache()
+def get_supported_image_formats():
+    """ Output formats the installed Pillow can encode, AVIF needs Pillow 11.2 or the AVIF plugin """
+    Image.init()
+    return tuple(image_format for image_format, (pil_format, mimetype, quality) in IMAGE_FORMATS.items()
+                 if pil_format in Image.SAVE)
+
+
+def negotiate_image_format(accept):
+    """ Return the preferred output format explicitly accepted by the client, JPEG being supported by all """
+    supported = get_supported_image_formats()
+    for image_format in ('avif', 'webp'):
+        if image_format in supported and IMAGE_FORMATS[image_format][1] in (accept or ''):
+            return image_format
+    return 'jpeg'
+
+
+def snap_image_size(width, height, breakpoints):
+    """
+    Scale the size up to the smallest breakpoint fitting its largest side, keeping the requested aspect ratio. A
+    single dimension is snapped alone, the other one follows the aspect ratio of the source.
+    """
+    largest = max(width, height)
+    breakpoint = next((size for size in breakpoints or () if size >= largest), None)
+    if not breakpoint or breakpoint == largest:
+        return width, height
+    return round(width * breakpoint / largest), round(height * breakpoint / largest)
+
+
+def _get_image_derivative_path(dbname, key):
+    return os.path.join(config.filestore(dbname), 'alokai_image_cache', key[:2], key)
+
+
+def load_image_derivative(dbname, key):
+    """ Return the filestore path of a cached image derivative, None when it is not cached """
+    path = _get_image_derivative_path(dbname, key)
+    try:
+        modified = os.stat(path).st_mtime
+    except OSError:
+        return None
+    # The modification date is the last time the derivative was served, for the garbage collection
+    now = time.time()
+    if now - modified > IMAGE_DERIVATIVE_TOUCH_INTERVAL:
+        try:
+            os.utime(path, (now, now))
+        except OSError:
+            pass
+    return path
+
+
+def save_image_derivative(dbname, key, data):
+    path = _get_image_derivative_path(dbname, key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as image_file:
+            image_file.write(data)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        _logger.warning('Unable to cache image derivative %s: %s', key, e)
+
+
+def gc_image_derivatives(dbname, max_age_days=IMAGE_DERIVATIVE_MAX_AGE_DAYS):
+    """
+    Delete the derivatives not served for max_age_days days. The derivatives are content addressed, so the ones of
+    replaced images, of former settings or of a former IMAGE_DERIVATIVE_VERSION are never served again.
+    Return the number of deleted files.
+    """
+    root = os.path.join(config.filestore(dbname), 'alokai_image_cache')
+    expiry = time.time() - max_age_days * 24 * 3600
+    deleted = 0
+    try:
+        directories = [entry.path for entry in os.scandir(root) if entry.is_dir()]
+    except OSError:
+        return deleted
+
+    for directory in directories:
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.stat().st_mtime < expiry:
+                            os.unlink(entry.path)
+                            deleted += 1
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+    return deleted
+
+
+def decode_image(data, draft_size=None):
+    """ Decode a source image, JPEG sources directly at the smallest DCT scale that is larger than the draft size """
+    image = Image.open(io.BytesIO(data))
+    if image.width * image.height > IMAGE_MAX_RESOLUTION:
+        raise UserError(_('Image size excessive, uploaded images must be smaller than %s million pixels.',
+                          str(IMAGE_MAX_RESOLUTION / 1e6)))
+    if image.format == 'JPEG' and draft_size:
+        image.draft('RGB', draft_size)
+    return image_fix_orientation(image)
+
+
+def render_image(data, width, height, crop, background_rgba, quality, image_format='webp'):
+    """ Render an image centered on a width x height canvas of the background color, encoded in image_format """
+    image = decode_image(data, (width or height, height or width))
+    return render_decoded_image(image, width, height, crop, background_rgba, quality, image_format)
+
+
+def render_decoded_image(image, width, height, crop, background_rgba, quality, image_format='webp'):
+    """ Render a decoded image, which is left untouched so several sizes can be rendered from a single decoding """
+    # A single dimension keeps the aspect ratio of the source, which is not upscaled
+    if not width or not height:
+        ratio = min(1, width / image.width if width else height / image.height)
+        width, height = max(1, round(image.width * ratio)), max(1, round(image.height * ratio))
+        crop = False
+
+    if crop:
+        image = ImageOps.fit(image, (width, height), Image.LANCZOS)
+    else:
+        image = image.copy()
+        image.thumbnail((width, height), Image.LANCZOS)
+
+    if len(background_rgba) == 3:
+        background_rgba = tuple(background_rgba) + (255,)
+    # JPEG has no alpha channel, the canvas is flattened on the background color
+    opaque = background_rgba[3] == 255 or image_format == 'jpeg'
+    canvas = Image.new('RGB' if opaque else 'RGBA', (width, height), background_rgba[:3] if opaque else background_rgba)
+
+    # Composite once, with the alpha of the image as mask
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        mask = image
+    else:
+        image = image.convert(canvas.mode)
+        mask = None
+    canvas.paste(image, ((width - image.width) // 2, (height - image.height) // 2), mask)
+
+    output = io.BytesIO()
+    canvas.save(output, format=IMAGE_FORMATS[image_format][0], quality=quality)
+    return output.getvalue()
+
 
 class IrBinary(models.AbstractModel):
     _inherit = 'ir.binary'
@@ -21,79 +188,95 @@ class IrBinary(models.AbstractModel):
         mimetype=None, default_mimetype='image/png', placeholder=None,
         width=0, height=0, crop=False, quality=0,
     ):
-        stream = super()._get_image_stream_from(record=record, field_name=field_name, filename=filename, filename_field=filename_field,
-                                    mimetype=mimetype, default_mimetype=default_mimetype, placeholder=placeholder,
-                                    width=width, height=height, crop=crop, quality=quality)
+        image_format = self._get_image_output_format()
+        output_mimetype = IMAGE_FORMATS[image_format][1]
+
+        # Resized images are content addressed, a cached derivative is streamed from the filestore as is
+        derivative_key = (width or height) and self._get_image_derivative_key(
+            record, field_name, width, height, crop, image_format)
+        if derivative_key:
+            # The key is the strong etag of the derivative, a conditional request is answered without any image work
+            if request and derivative_key in request.httprequest.if_none_match:
+                return Stream(type='data', data=b'', mimetype=output_mimetype, size=0, etag=derivative_key)
+
+            path = load_image_derivative(self.env.cr.dbname, derivative_key)
+            if path:
+                stream = Stream(type='path', path=path, mimetype=output_mimetype, size=os.path.getsize(path),
+                                etag=derivative_key)
+                self._update_download_name(record, stream, filename, field_name, filename_field, output_mimetype,
+                                           default_mimetype)
+                return stream
+
+        # A resized image is rendered from the source in one pass, so the source is not decoded by super()
+        resize = bool(width or height)
+        stream = super()._get_image_stream_from(
+            record=record, field_name=field_name, filename=filename, filename_field=filename_field,
+            mimetype=mimetype, default_mimetype=default_mimetype, placeholder=placeholder,
+            width=0 if resize else width, height=0 if resize else height,
+            crop=False if resize else crop, quality=0 if resize else quality)
         if not stream or stream.size == 0:
             if not placeholder:
                 placeholder = record._get_placeholder_filename(field_name)
             stream = self._get_placeholder_stream(placeholder)
 
-        image_format = None
-        if stream and stream.mimetype and ('jpg' in stream.mimetype or 'jpeg' in stream.mimetype):
-            image_format = 'jpeg'
-        if stream and stream.mimetype and ('png' in stream.mimetype or 'png' in stream.mimetype):
-            image_format = 'png'
-        if stream and stream.mimetype and 'webp' in stream.mimetype:
+        if not stream.mimetype or stream.mimetype not in RENDERED_MIMETYPES:
+            return stream
+
+        if not resize:
+            self._update_download_name(record, stream, filename, field_name, filename_field, None, default_mimetype)
+            return stream
+
+        data = stream.data or stream.read()
+        if data:
+            data = render_image(
+                data, width, height, crop, self._get_image_background_rgba(),
+                self.env['alokai.settings'].get(IMAGE_FORMATS[image_format][2]), image_format)
+            stream.type = 'data'
+            stream.data = data
+            stream.path = None
+            stream.size = len(data)
+            if derivative_key:
+                save_image_derivative(self.env.cr.dbname, derivative_key, data)
+                stream.etag = derivative_key
+        self._update_download_name(record, stream, filename, field_name, filename_field, output_mimetype,
+                                   default_mimetype)
+        return stream
+
+    def _get_image_output_format(self):
+        """ Output format of the resized images, negotiated by the image route, WEBP by default """
+        image_format = self.env.context.get('alokai_image_format')
+        if image_format not in get_supported_image_formats():
             image_format = 'webp'
+        return image_format
 
-        if not stream.data:
-            stream.data = stream.read()
-        
-        if image_format:
-            if stream.data and width and height:
-                image_base64 = stream.data
-                #TODO remove when odoo fix webp resize issue
-                # FIX: convert webp to png and then resize it
-                if image_format == 'webp':
-                    new_image_base64 = self.webp_base64_to_png(stream.read())
-                    image_base64 = image_process(
-                        new_image_base64,
-                        size=(width, height),
-                        crop=crop,
-                        quality=quality,
-                    )
-
-                img = Image.open(io.BytesIO(image_base64))
-
-                ICP = request.env['ir.config_parameter'].sudo()
-                if img.mode != 'RGBA':
-                    img = img.convert('RGBA')
-
-                # Get background color from context or settings
-                try:
-                    if self.env.context.get('background_rgba'):
-                        background_rgba = safe_eval(self.env.context.get('background_rgba'))
-                    else:
-                        background_rgba = safe_eval(ICP.get_param('alokai_image_background_rgba', '(255, 255, 255, 255)'))
-                except:
-                    background_rgba = (66, 28, 82)
-                # Create a new background, merge the background with the image centered
-                img_w, img_h = img.size
-                if image_format in ['jpeg', 'png']:
-                    background = Image.new('RGB', (width, height), background_rgba[:3])
-                else:
-                    background = WebPImagePlugin.Image.new('RGBA', (width, height), background_rgba)
-                bg_w, bg_h = background.size
-                offset = ((bg_w - img_w) // 2, (bg_h - img_h) // 2)
-                background.paste(img, offset)
-
-                # Get compression quality from settings
-                quality = ICP.get_param('alokai_image_quality', 100)
-
-                stream_image = io.BytesIO()
-                if image_format in ['jpeg', 'png']:
-                    background.save(stream_image, format="WEBP", subsampling=0)
-                    stream_image.seek(0)
-                else:
-                    background.save(stream_image, format=image_format.upper(), quality=quality, subsampling=0)
+    def _get_image_background_rgba(self):
+        """ Background color from context or settings """
+        try:
+            if self.env.context.get('background_rgba'):
+                return tuple(safe_eval(self.env.context.get('background_rgba')))
+            return self.env['alokai.settings'].get('alokai_image_background_rgba')
+        except Exception:
+            return (66, 28, 82)
 
-                image_base64 = base64.b64encode(stream_image.getvalue())
+    def _get_image_derivative_key(self, record, field_name, width, height, crop, image_format):
+        """
+        Return the key of the derivative of an image: a hash of the checksum of the source image and of the rendering
+        parameters, None when the source has no checksum
+        """
+        try:
+            source = self._get_stream_from(record, field_name)
+        except UserError:
+            return None
+        if not source or not source.etag:
+            return None
+        return self._compute_image_derivative_key(source.etag, width, height, crop, image_format)
 
-                # Response
-                stream.data = base64.b64decode(image_base64)
-            self._update_download_name(record, stream, filename, field_name, filename_field, f'image/webp', default_mimetype)
-        return stream
+    def _compute_image_derivative_key(self, source_etag, width, height, crop, image_format):
+        key = json.dumps([
+            IMAGE_DERIVATIVE_VERSION, source_etag, width, height, bool(crop), list(self._get_image_background_rgba()),
+            self.env['alokai.settings'].get(IMAGE_FORMATS[image_format][2]), image_format,
+        ])
+        return hashlib.sha256(key.encode()).hexdigest()
 
     def _update_download_name(self, record, stream, filename, field_name, filename_field, mimetype, default_mimetype):
         if stream.type in ('data', 'path'):
@@ -118,20 +301,3 @@ class IrBinary(models.AbstractModel):
             if (not get_extension(stream.download_name)
                 and stream.mimetype != 'application/octet-stream'):
                 stream.download_name += guess_extension(stream.mimetype) or ''
-
-    def webp_base64_to_png(self, image_bytes):
-        """
-        Converts a WebP image encoded in base64 to a PNG image.
-        """
-
-        # Create an Image object from the bytes
-        image = Image.open(io.BytesIO(image_bytes))
-
-        # Convert the image to PNG format
-        image = image.convert('RGB')
-
-        stream = io.BytesIO()
-        # Save the image as a PNG
-        image.save(stream, format='PNG')
-
-        return stream.getvalue()
\ No newline at end of file
@@ -7,9 +7,17 @@ from odoo.osv import expression
 from collections import defaultdict
 from datetime import timedelta
 from odoo import models, fields, api, _
+from odoo.tools import SQL, split_every
 from odoo.tools.float_utils import float_round
 from odoo.exceptions import ValidationError
 
+STOCK_REDIS_BATCH_SIZE = 5000
+# Redis set of the ids of the products whose stock changed, and maximum number of batches synced per cron run
+STOCK_DIRTY_REDIS_KEY = 'product-stock-dirty'
+STOCK_DIRTY_MAX_BATCHES = 20
+# Per product dirty keys of the versions before the dirty set
+STOCK_DIRTY_LEGACY_KEY_PREFIX = 'product-stock-is-dirty-'
+
 
 class ProductTemplate(models.Model):
     _inherit = 'product.template'
@@ -124,10 +132,124 @@ class ProductTemplate(models.Model):
             filtered_attributes
         )
 
+    @api.model
+    def _graphql_get_facets(self, domain, filtered_attributes, min_price=None, max_price=None,
+                            attribute_value_ids=None):
+        """
+        Compute the facets of a product search in a single SQL aggregation.
+
+        `domain` is the search domain without the attribute and price filters. A product matches the search when it
+        has at least one of the selected values of every filtered attribute and its price is in the price range.
+
+        The count of an attribute value is the number of products that have it and match every filter except the one
+        on its own attribute, so the other values of a filtered attribute are still offered. The min and max prices
+        are calculated without the price filter.
+
+        Returns a dictionary with the total count, the in stock count, the min and max prices and the counts of the
+        available attribute values.
+        """
+        website = self.env['website'].get_current_website()
+        query = self._search(domain)
+
+        attribute_conditions = {
+            attribute_id: SQL("product.value_ids && %s::int[]", value_ids)
+            for attribute_id, value_ids in filtered_attributes.items()
+        }
+
+        price_conditions = []
+        if min_price:
+            price_conditions.append(SQL("product.list_price >= %s", float(min_price)))
+        if max_price:
+            price_conditions.append(SQL("product.list_price <= %s", float(max_price)))
+
+        def sql_and(conditions):
+            return SQL(" AND ").join(conditions) if conditions else SQL("TRUE")
+
+        match_attributes = sql_and(list(attribute_conditions.values()))
+        match_all = sql_and(list(attribute_conditions.values()) + price_conditions)
+        # Every filter except the one on the attribute of the value being counted
+        match_value = sql_and([
+            SQL("(value.attribute_id = %s OR %s)", attribute_id, condition)
+            for attribute_id, condition in attribute_conditions.items()
+        ] + price_conditions)
+
+        value_join_condition = SQL("value.id = variant_value.product_attribute_value_id AND value.visibility = 'visible'")
+        if attribute_value_ids:
+            value_join_condition = SQL("%s AND value.id = ANY(%s)", value_join_condition, list(attribute_value_ids))
+
+        self.env.cr.execute(SQL("""
+            WITH product AS (
+                SELECT product_template.id,
+                       product_template.list_price,
+                       EXISTS (
+                           SELECT 1
+                           FROM product_template_redis_stock stock
+                           WHERE stock.product_id = product_template.id
+                           AND stock.website_id = %(website_id)s
+                           AND stock.quantity > 0
+                       ) AS in_stock,
+                       COALESCE(
+                           array_agg(DISTINCT line_value.product_attribute_value_id)
+                           FILTER (WHERE line_value.product_attribute_value_id IS NOT NULL),
+                           '{}'
+                       ) AS value_ids
+                FROM product_template
+                LEFT JOIN product_template_attribute_line line
+                    ON line.product_tmpl_id = product_template.id AND line.active
+                LEFT JOIN product_attribute_value_product_template_attribute_line_rel line_value
+                    ON line_value.product_template_attribute_line_id = line.id
+                WHERE product_template.id IN %(product_ids)s
+                GROUP BY product_template.id, product_template.list_price
+            )
+            SELECT GROUPING(variant_value.product_attribute_value_id) = 1 AS is_total,
+                   variant_value.product_attribute_value_id AS value_id,
+                   COUNT(DISTINCT product.id) FILTER (WHERE %(match_all)s) AS total_count,
+                   COUNT(DISTINCT product.id) FILTER (WHERE %(match_all)s AND product.in_stock) AS in_stock_count,
+                   MIN(product.list_price) FILTER (WHERE %(match_attributes)s) AS min_price,
+                   MAX(product.list_price) FILTER (WHERE %(match_attributes)s) AS max_price,
+                   COUNT(DISTINCT product.id) FILTER (
+                       WHERE %(match_value)s AND variant_value.product_attribute_value_id = ANY(product.value_ids)
+                   ) AS value_count,
+                   COALESCE(bool_or(%(match_value)s), FALSE) AS value_available
+            FROM product
+            LEFT JOIN (
+                product_template_variant_product_attribute_value_rel variant_value
+                JOIN product_attribute_value value ON %(value_join_condition)s
+            ) ON variant_value.product_template_id = product.id
+            GROUP BY GROUPING SETS ((variant_value.product_attribute_value_id), ())
+        """,
+            website_id=website.id,
+            product_ids=query.subselect(),
+            match_all=match_all,
+            match_attributes=match_attributes,
+            match_value=match_value,
+            value_join_condition=value_join_condition,
+        ))
+
+        facets = {
+            'total_count': 0,
+            'in_stock_count': 0,
+            'min_price': 0.0,
+            'max_price': 0.0,
+            'attribute_value_counts': {},
+        }
+        for row in self.env.cr.dictfetchall():
+            if row['is_total']:
+                facets.update({
+                    'total_count': row['total_count'],
+                    'in_stock_count': row['in_stock_count'],
+                    'min_price': row['min_price'] or 0.0,
+                    'max_price': row['max_price'] or 0.0,
+                })
+            elif row['value_id'] and row['value_available']:
+                facets['attribute_value_counts'][row['value_id']] = row['value_count']
+
+        return facets
+
     def _compute_json_ld(self):
         env = self.env
         website = env['website'].get_current_website()
-        base_url = env['ir.config_parameter'].sudo().get_param('web.base.url', '')
+        base_url = env['alokai.settings'].get('web.base.url')
         if base_url and base_url[-1:] == '/':
             base_url = base_url[:-1]
 
@@ -229,7 +351,7 @@ class ProductTemplate(models.Model):
             product.variant_attribute_value_ids = [(6, 0, attribute_values.ids)]
 
     def _compute_recent_sales_count(self):
-        lookback_days = int(self.env['ir.config_parameter'].sudo().get_param('alokai_recent_sales_count_days', 30))
+        lookback_days = self.env['alokai.settings'].get('alokai_recent_sales_count_days')
         date_days_ago = fields.Datetime.now() - timedelta(days=lookback_days)
         done_states = self.env['sale.report'].sudo()._get_done_states()
         domain = [
@@ -269,13 +391,21 @@ class ProductTemplate(models.Model):
     product_tmpl_redis_stock_ids = fields.One2many('product.template.redis_stock', 'product_id', 'Redis Stock',
                                                    readonly=True)
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        products = super(ProductTemplate, self).create(vals_list)
+        self.env['alokai.route.change']._record_changes(self._name, products.ids)
+        return products
+
     def write(self, vals):
         res = super(ProductTemplate, self).write(vals)
         self.env['invalidate.cache'].create_invalidate_cache(self._name, self.ids)
+        self.env['alokai.route.change']._record_changes(self._name, self.ids, vals)
         return res
 
     def unlink(self):
         self.env['invalidate.cache'].create_invalidate_cache(self._name, self.ids)
+        self.env['alokai.route.change']._record_changes(self._name, self.ids)
         return super(ProductTemplate, self).unlink()
 
     def _get_combination_info(self, combination=False, product_id=False, add_qty=1, parent_combination=False,
@@ -363,7 +493,7 @@ class ProductProduct(models.Model):
     def _compute_json_ld(self):
         env = self.env
         website = env['website'].get_current_website()
-        base_url = env['ir.config_parameter'].sudo().get_param('web.base.url', '')
+        base_url = env['alokai.settings'].get('web.base.url')
         if base_url and base_url[-1:] == '/':
             base_url = base_url[:-1]
 
@@ -401,44 +531,117 @@ class ProductProduct(models.Model):
             product.json_ld = json.dumps(json_ld)
 
     def _update_dirty_products_stock_redis(self):
+        """
+        Drain the dirty products set in batches. SPOP removes the ids atomically, so the ids added during the sync
+        stay in the set for the next batch, and the ids of a failed batch are added back.
+        """
         redis_client = self.env['website']._redis_connect()
-        dirty_keys = [key for key in redis_client.scan_iter('product-stock-is-dirty-*')]
-        product_ids = [int(redis_client.get(dirty_key)) for dirty_key in dirty_keys]
-        products = self.search([('id', 'in', product_ids)])
-
-        self._update_products_stock_redis(redis_client, products)
-
-        for dirty_key in dirty_keys:
-            redis_client.delete(dirty_key)
+        self.env['product.stock.dirty']._move_to_redis(redis_client)
+
+        for _batch in range(STOCK_DIRTY_MAX_BATCHES):
+            dirty_ids = redis_client.spop(STOCK_DIRTY_REDIS_KEY, STOCK_REDIS_BATCH_SIZE)
+            if not dirty_ids:
+                break
+
+            try:
+                products = self.search([('id', 'in', [int(product_id) for product_id in dirty_ids])])
+                self._update_products_stock_redis(redis_client, products)
+                self.env.cr.commit()
+            except Exception:
+                self.env.cr.rollback()
+                redis_client.sadd(STOCK_DIRTY_REDIS_KEY, *dirty_ids)
+                raise
+
+    def _migrate_legacy_stock_dirty_redis(self):
+        """ Move the products of the legacy per product dirty keys to the dirty set, and delete these keys """
+        redis_client = self.env['website']._redis_connect()
+        legacy_keys = redis_client.scan_iter(match=f'{STOCK_DIRTY_LEGACY_KEY_PREFIX}*', count=1000)
+        for keys in split_every(1000, legacy_keys, list):
+            product_ids = [
+                product_id for product_id in (key[len(STOCK_DIRTY_LEGACY_KEY_PREFIX):] for key in keys)
+                if product_id.isdigit()
+            ]
+            pipe = redis_client.pipeline()
+            if product_ids:
+                pipe.sadd(STOCK_DIRTY_REDIS_KEY, *product_ids)
+            pipe.unlink(*keys)
+            pipe.execute()
 
     def _update_all_products_stock_redis(self):
         redis_client = self.env['website']._redis_connect()
         products = self.search([])
         self._update_products_stock_redis(redis_client, products)
 
-    def _update_products_stock_redis(self, redis_client, products):
-        if products:
-            product_tmpls = products.mapped('product_tmpl_id')
-            websites = self.env['website'].search([])
-
-            ProductProductRedisStock = self.env['product.product.redis_stock']
-            ProductTemplateRedisStock = self.env['product.template.redis_stock']
-            pipe = redis_client.pipeline()
-
-            for product in products:
-                data = {}
-                for website in websites:
-                    ProductProductRedisStock.create_redis_stock(product.id, website.id, product.free_qty)
-                    data.update({website.id: self.free_qty})
-                pipe.set(f'product-stock-{product.id}', json.dumps(data))
-
-            for product_tmpl in product_tmpls:
-                for website in websites:
-                    free_qty = sum(product_tmpl.product_variant_ids.mapped('free_qty'))
-                    ProductTemplateRedisStock.create_redis_stock(product_tmpl.id, website.id, free_qty)
+    @api.model
+    def _get_website_warehouses(self, websites):
+        """ Return {website id: warehouse id}, the warehouse of the website or else the first one of its company """
+        warehouses = {}
+        for website in websites:
+            warehouse = website.warehouse_id if 'warehouse_id' in website._fields else False
+            if not warehouse:
+                warehouse = self.env['stock.warehouse'].sudo().search(
+                    [('company_id', '=', website.company_id.id)], limit=1)
+            warehouses[website.id] = warehouse.id
+        return warehouses
+
+    def _get_free_qty_by_warehouse(self, warehouse_ids):
+        """ Return {(product id, warehouse id): free quantity} with one grouped query on the quants per batch """
+        free_qty = {}
+        for product_ids in split_every(STOCK_REDIS_BATCH_SIZE, self.ids, list):
+            self.env.cr.execute("""
+                SELECT quant.product_id, location.warehouse_id, SUM(quant.quantity - quant.reserved_quantity)
+                FROM stock_quant quant
+                JOIN stock_location location ON location.id = quant.location_id
+                WHERE location.usage = 'internal'
+                AND location.warehouse_id = ANY(%s)
+                AND quant.product_id = ANY(%s)
+                GROUP BY quant.product_id, location.warehouse_id
+            """, (list(warehouse_ids), product_ids))
+            for product_id, warehouse_id, quantity in self.env.cr.fetchall():
+                free_qty[product_id, warehouse_id] = quantity
+        return free_qty
 
+    def _update_products_stock_redis(self, redis_client, products):
+        if not products:
+            return
+
+        websites = self.env['website'].search([])
+        if not websites:
+            return
+
+        self.env['stock.quant'].flush_model(['product_id', 'location_id', 'quantity', 'reserved_quantity'])
+        website_warehouses = self._get_website_warehouses(websites)
+
+        # The quantity of a template is the sum of all its variants, not only the updated ones
+        product_tmpl_ids = products.mapped('product_tmpl_id').ids
+        variants = self.search([('product_tmpl_id', 'in', product_tmpl_ids)])
+        warehouse_ids = {warehouse_id for warehouse_id in website_warehouses.values() if warehouse_id}
+        warehouse_free_qty = (products | variants)._get_free_qty_by_warehouse(warehouse_ids)
+
+        def get_free_qty(product_id, website_id):
+            return float(warehouse_free_qty.get((product_id, website_warehouses[website_id]), 0.0))
+
+        template_free_qty = defaultdict(float)
+        for row in variants.read(['product_tmpl_id'], load=None):
+            for website in websites:
+                template_free_qty[row['product_tmpl_id'], website.id] += get_free_qty(row['id'], website.id)
+
+        # product-stock-<id> keeps its JSON format read by the storefront, {website id: free quantity in the
+        # warehouse of the website}
+        pipe = redis_client.pipeline(transaction=False)
+        for product_ids in split_every(STOCK_REDIS_BATCH_SIZE, products.ids, list):
+            for product_id in product_ids:
+                data = {website.id: get_free_qty(product_id, website.id) for website in websites}
+                pipe.set(f'product-stock-{product_id}', json.dumps(data))
             pipe.execute()
 
+        self.env['product.product.redis_stock']._upsert_redis_stock(
+            [(product_id, website.id, get_free_qty(product_id, website.id))
+             for product_id in products.ids for website in websites])
+        self.env['product.template.redis_stock']._upsert_redis_stock(
+            [(product_tmpl_id, website.id, template_free_qty[product_tmpl_id, website.id])
+             for product_tmpl_id in product_tmpl_ids for website in websites])
+
 
 class ProductStockRedis(models.AbstractModel):
     _name = 'product.redis_stock'
@@ -446,17 +649,54 @@ class ProductStockRedis(models.AbstractModel):
     website_id = fields.Many2one('website', 'Website', required=True)
     quantity = fields.Float('Quantity', digits='Product Unit of Measure', required=True)
 
+    def init(self):
+        super().init()
+        if self._abstract:
+            return
+
+        # A single line per product and website, upserted by _upsert_redis_stock
+        self.env.cr.execute(SQL(
+            """
+            DELETE FROM %(table)s a
+            USING %(table)s b
+            WHERE a.product_id = b.product_id AND a.website_id = b.website_id AND a.id > b.id
+            """,
+            table=SQL.identifier(self._table),
+        ))
+        self.env.cr.execute(SQL(
+            "CREATE UNIQUE INDEX IF NOT EXISTS %(index)s ON %(table)s (product_id, website_id)",
+            index=SQL.identifier(f'{self._table}_product_website_uniq'),
+            table=SQL.identifier(self._table),
+        ))
+
+    @api.model
+    def _upsert_redis_stock(self, lines):
+        """ Insert or update the (product id, website id, quantity) lines with a query per batch """
+        now = fields.Datetime.now()
+        for batch in split_every(STOCK_REDIS_BATCH_SIZE, lines, list):
+            product_ids, website_ids, quantities = zip(*batch)
+            self.env.cr.execute(SQL(
+                """
+                INSERT INTO %(table)s (product_id, website_id, quantity, create_uid, create_date, write_uid, write_date)
+                SELECT line.product_id, line.website_id, line.quantity, %(uid)s, %(now)s, %(uid)s, %(now)s
+                FROM unnest(%(product_ids)s::int[], %(website_ids)s::int[], %(quantities)s::numeric[])
+                    AS line(product_id, website_id, quantity)
+                ON CONFLICT (product_id, website_id) DO UPDATE
+                SET quantity = EXCLUDED.quantity, write_uid = EXCLUDED.write_uid, write_date = EXCLUDED.write_date
+                WHERE %(table)s.quantity IS DISTINCT FROM EXCLUDED.quantity
+                """,
+                table=SQL.identifier(self._table),
+                uid=self.env.uid,
+                now=now,
+                product_ids=list(product_ids),
+                website_ids=list(website_ids),
+                quantities=list(quantities),
+            ))
+        self.invalidate_model(['quantity'])
+
     @api.model
     def create_redis_stock(self, product_id, website_id, quantity):
-        line = self.search([('product_id', '=', product_id), ('website_id', '=', website_id)])
-        if line:
-            line.quantity = quantity
-        else:
-            self.create({
-                'product_id': product_id,
-                'website_id': website_id,
-                'quantity': quantity,
-            })
+        self._upsert_redis_stock([(product_id, website_id, quantity)])
 
 
 class ProductProductRedisStock(models.Model):
@@ -513,6 +753,7 @@ class ProductPublicCategory(models.Model):
             else:
                 rec.website_slug = f'/category/{rec.id}'
 
+        self.env['alokai.route.change']._record_changes(self._name, res.ids)
         return res
 
     def write(self, vals):
@@ -520,10 +761,12 @@ class ProductPublicCategory(models.Model):
         if vals.get('website_slug', False):
             self._validate_website_slug()
         self.env['invalidate.cache'].create_invalidate_cache(self._name, self.ids)
+        self.env['alokai.route.change']._record_changes(self._name, self.ids, vals)
         return res
 
     def unlink(self):
         self.env['invalidate.cache'].create_invalidate_cache(self._name, self.ids)
+        self.env['alokai.route.change']._record_changes(self._name, self.ids)
         return super(ProductPublicCategory, self).unlink()
 
 
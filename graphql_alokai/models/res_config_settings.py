@@ -7,6 +7,8 @@ from odoo import api, fields, models, _
 from odoo.exceptions import ValidationError
 from odoo.tools.safe_eval import safe_eval
 
+from .ir_binary import IMAGE_FORMATS
+
 
 class ResConfigSettings(models.TransientModel):
     _inherit = 'res.config.settings'
@@ -31,14 +33,23 @@ class ResConfigSettings(models.TransientModel):
                                                            related='website_id.order_confirmation_email_template_id', readonly=False, required=True)
 
     # Alokai Images
-    alokai_image_quality = fields.Integer('Quality (%)', required=True)
+    alokai_image_quality = fields.Integer('WebP Quality (%)', required=True)
+    alokai_image_quality_avif = fields.Integer('AVIF Quality (%)', required=True)
+    alokai_image_quality_jpeg = fields.Integer('JPEG Quality (%)', required=True)
+    alokai_image_breakpoints = fields.Char('Image Sizes', required=True)
     alokai_image_background_rgba = fields.Char('Background RGBA', required=True)
+    alokai_image_pregenerate_sizes = fields.Char('Pre-generated Image Sizes')
+    alokai_image_pregenerate_formats = fields.Char('Pre-generated Image Formats')
     alokai_image_resize_limit = fields.Integer('Resize Limit', required=True)
     alokai_recent_sales_count_days = fields.Integer('Recent Sales Count (days)', required=True)
 
     # Redis
     alokai_redis_host = fields.Char('Redis Host', default='localhost')
     alokai_redis_port = fields.Integer('Redis Port', default=6379)
+    alokai_redis_db = fields.Integer('Redis Database', default=0)
+    alokai_redis_unix_socket = fields.Char('Redis Unix Socket')
+    alokai_graphql_cache = fields.Boolean('GraphQL Response Cache')
+    alokai_graphql_cache_ttl = fields.Integer('GraphQL Response Cache TTL (seconds)', default=300)
 
     def get_values(self):
         res = super(ResConfigSettings, self).get_values()
@@ -49,17 +60,44 @@ class ResConfigSettings(models.TransientModel):
             alokai_cache_invalidation_key=ICP.get_param('alokai_cache_invalidation_key'),
             alokai_cache_invalidation_url=ICP.get_param('alokai_cache_invalidation_url'),
             alokai_image_quality=int(ICP.get_param('alokai_image_quality', 100)),
+            alokai_image_quality_avif=int(ICP.get_param('alokai_image_quality_avif', 60)),
+            alokai_image_quality_jpeg=int(ICP.get_param('alokai_image_quality_jpeg', 85)),
+            alokai_image_breakpoints=ICP.get_param('alokai_image_breakpoints', '128,256,512,1024,1920'),
             alokai_image_background_rgba=ICP.get_param('alokai_image_background_rgba', '(255, 255, 255, 255)'),
+            alokai_image_pregenerate_sizes=ICP.get_param('alokai_image_pregenerate_sizes', '512x512,1024x1024'),
+            alokai_image_pregenerate_formats=ICP.get_param('alokai_image_pregenerate_formats', 'webp'),
             alokai_image_resize_limit=int(ICP.get_param('alokai_image_resize_limit', 1920)),
             alokai_recent_sales_count_days=int(ICP.get_param('alokai_recent_sales_count_days', 30)),
             alokai_redis_host=ICP.get_param('alokai_redis_host', 'localhost'),
             alokai_redis_port=int(ICP.get_param('alokai_redis_port', 6379)),
+            alokai_redis_db=int(ICP.get_param('alokai_redis_db', 0)),
+            alokai_redis_unix_socket=ICP.get_param('alokai_redis_unix_socket'),
+            alokai_graphql_cache=ICP.get_param('alokai_graphql_cache'),
+            alokai_graphql_cache_ttl=int(ICP.get_param('alokai_graphql_cache_ttl', 300)),
         )
         return res
 
     def set_values(self):
-        if self.alokai_image_quality < 0 or self.alokai_image_quality > 100:
-            raise ValidationError(_('Invalid image quality percentage.'))
+        for quality in (self.alokai_image_quality, self.alokai_image_quality_avif, self.alokai_image_quality_jpeg):
+            if quality < 0 or quality > 100:
+                raise ValidationError(_('Invalid image quality percentage.'))
+
+        try:
+            [int(size) for size in (self.alokai_image_breakpoints or '').split(',') if size.strip()]
+        except ValueError:
+            raise ValidationError(_('Invalid image sizes, expected comma separated numbers of pixels.'))
+
+        try:
+            [[int(side) for side in size.strip().split('x', 1)]
+             for size in (self.alokai_image_pregenerate_sizes or '').split(',') if size.strip()]
+        except ValueError:
+            raise ValidationError(_('Invalid pre-generated image sizes, expected comma separated <width>x<height>.'))
+
+        image_formats = [item.strip() for item in (self.alokai_image_pregenerate_formats or '').split(',')
+                         if item.strip()]
+        if any(image_format not in IMAGE_FORMATS for image_format in image_formats):
+            raise ValidationError(_('Invalid pre-generated image formats, expected some of %s.',
+                                    ', '.join(IMAGE_FORMATS)))
 
         if self.alokai_image_resize_limit < 0:
             raise ValidationError(_('Invalid image resize limit.'))
@@ -71,11 +109,20 @@ class ResConfigSettings(models.TransientModel):
         ICP.set_param('alokai_cache_invalidation_key', self.alokai_cache_invalidation_key)
         ICP.set_param('alokai_cache_invalidation_url', self.alokai_cache_invalidation_url)
         ICP.set_param('alokai_image_quality', self.alokai_image_quality)
+        ICP.set_param('alokai_image_quality_avif', self.alokai_image_quality_avif)
+        ICP.set_param('alokai_image_quality_jpeg', self.alokai_image_quality_jpeg)
+        ICP.set_param('alokai_image_breakpoints', self.alokai_image_breakpoints)
         ICP.set_param('alokai_image_background_rgba', self.alokai_image_background_rgba)
+        ICP.set_param('alokai_image_pregenerate_sizes', self.alokai_image_pregenerate_sizes or '')
+        ICP.set_param('alokai_image_pregenerate_formats', self.alokai_image_pregenerate_formats or '')
         ICP.set_param('alokai_image_resize_limit', self.alokai_image_resize_limit)
         ICP.set_param('alokai_recent_sales_count_days', self.alokai_recent_sales_count_days)
         ICP.set_param('alokai_redis_host', self.alokai_redis_host)
         ICP.set_param('alokai_redis_port', self.alokai_redis_port)
+        ICP.set_param('alokai_redis_db', self.alokai_redis_db)
+        ICP.set_param('alokai_redis_unix_socket', self.alokai_redis_unix_socket)
+        ICP.set_param('alokai_graphql_cache', self.alokai_graphql_cache)
+        ICP.set_param('alokai_graphql_cache_ttl', self.alokai_graphql_cache_ttl)
 
     @api.model
     def create_alokai_cache_invalidation_key(self):
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import gzip
+import json
+from datetime import timedelta
+
+from odoo import api, fields, models
+from odoo.tools import SQL
+from odoo.tools.lru import LRU
+
+# Model: (manifest section, fields changing the route, None for any field)
+ROUTE_MODELS = {
+    'product.template': ('products', {'name', 'is_published', 'website_published', 'active', 'website_id'}),
+    'product.public.category': ('categories', {'name', 'website_slug', 'website_id'}),
+    'website.rewrite': ('redirects', None),
+}
+ROUTE_CHANGE_RETENTION_DAYS = 30
+# Manifests built at request time, until the refresh cron stores them, by database, website, language and version
+route_manifest_cache = LRU(16)
+
+
+class AlokaiRouteChange(models.Model):
+    """
+    Log of the records whose storefront route changed, by version of the route manifests: the changes after a version
+    are the delta to apply to a manifest of that version.
+    The writers only insert unversioned changes, the refresh cron assigns them the next version. The cron runs alone,
+    so a change committed late is given a later version instead of being skipped, without the writers waiting on
+    each other.
+    """
+    _name = 'alokai.route.change'
+    _description = 'Alokai Route Change'
+    _order = 'version, id'
+
+    res_model = fields.Char('Res Model', required=True)
+    res_id = fields.Integer('Res ID', required=True)
+    version = fields.Integer('Version', index=True)
+
+    @api.model
+    def _record_changes(self, res_model, res_ids, vals=None):
+        """ Log the records, on a write only when one of the route fields of the model is written """
+        route_fields = ROUTE_MODELS[res_model][1]
+        if not res_ids or (vals is not None and route_fields is not None and not route_fields & set(vals)):
+            return
+
+        now = fields.Datetime.now()
+        uid = self.env.uid
+        self.env.cr.execute("""
+            INSERT INTO alokai_route_change(res_model, res_id, create_date, write_date, create_uid, write_uid)
+            SELECT %s, res_id, %s, %s, %s, %s
+            FROM unnest(%s::int[]) AS res_id;
+        """, (res_model, now, now, uid, uid, list(res_ids)))
+
+    @api.model
+    def _assign_version(self):
+        """ Give the committed unversioned changes the next version, return whether there were any """
+        self.env.cr.execute("""
+            UPDATE alokai_route_change
+            SET version = (SELECT COALESCE(MAX(version), 0) + 1 FROM alokai_route_change)
+            WHERE version IS NULL;
+        """)
+        return bool(self.env.cr.rowcount)
+
+    @api.model
+    def _get_version(self):
+        self.env.cr.execute("SELECT COALESCE(MAX(version), 0) FROM alokai_route_change")
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    def _get_oldest_version(self):
+        """ Return the oldest version a delta can be computed from, the older changes are purged """
+        self.env.cr.execute("SELECT COALESCE(MIN(version) - 1, 0) FROM alokai_route_change")
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    def _get_changes(self, since, version):
+        """ Return {res model: ids of the records changed after the since version, up to the version} """
+        self.env.cr.execute("""
+            SELECT res_model, array_agg(DISTINCT res_id)
+            FROM alokai_route_change
+            WHERE version > %s AND version <= %s
+            GROUP BY res_model;
+        """, (since, version))
+        return dict(self.env.cr.fetchall())
+
+    @api.model
+    def _purge_changes(self):
+        """ Delete the old changes, those of the last version are kept so the oldest version stays known """
+        cutoff = fields.Datetime.now() - timedelta(days=ROUTE_CHANGE_RETENTION_DAYS)
+        self.env.cr.execute("""
+            DELETE FROM alokai_route_change
+            WHERE create_date < %s AND version < (SELECT MAX(version) FROM alokai_route_change);
+        """, (cutoff,))
+
+
+class AlokaiRouteManifest(models.Model):
+    """
+    Materialized routes of the storefront for a website and a language: the product and category slugs and the
+    redirects, keyed by record id. The manifest is stored gzip compressed, ready to be served, and is brought up to
+    date by applying the route changes logged since its version.
+    """
+    _name = 'alokai.route.manifest'
+    _description = 'Alokai Route Manifest'
+
+    website_id = fields.Many2one('website', 'Website', required=True, ondelete='cascade')
+    lang = fields.Char('Language', required=True)
+    version = fields.Integer('Version', required=True, default=0)
+    last_modified = fields.Datetime('Last Modified')
+    data = fields.Binary('Data', attachment=False)
+
+    def init(self):
+        super().init()
+        self.env.cr.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS alokai_route_manifest_website_lang_uniq
+            ON alokai_route_manifest(website_id, lang);
+        """)
+
+    @api.model
+    def _read_routes(self, res_model, website, lang, ids=None):
+        """ Return {id: route} of the records visible on the website, restricted to the ids if given """
+        website_condition = SQL("(website_id IS NULL OR website_id = %s)", website.id)
+        ids_condition = SQL("id = ANY(%s)", list(ids)) if ids is not None else SQL("TRUE")
+        slug = SQL("COALESCE(website_slug->>%s, website_slug->>'en_US')", lang)
+
+        if res_model == 'product.template':
+            query = SQL(
+                "SELECT id, %s FROM product_template WHERE is_published AND active AND website_slug IS NOT NULL "
+                "AND %s AND %s", slug, website_condition, ids_condition)
+        elif res_model == 'product.public.category':
+            query = SQL(
+                "SELECT id, %s FROM product_public_category WHERE website_slug IS NOT NULL AND %s AND %s",
+                slug, website_condition, ids_condition)
+        else:
+            query = SQL(
+                "SELECT id, json_build_object('from', url_from, 'to', url_to) FROM website_rewrite "
+                "WHERE active AND %s AND %s", website_condition, ids_condition)
+
+        self.env.cr.execute(query)
+        return {str(record_id): route for record_id, route in self.env.cr.fetchall() if route}
+
+    def _load(self):
+        self.ensure_one()
+        self.env.cr.execute("SELECT data FROM alokai_route_manifest WHERE id = %s", (self.id,))
+        data = self.env.cr.fetchone()[0]
+        return data and bytes(data)
+
+    @api.model
+    def _build(self, website, lang, data, since, version):
+        """
+        Return the gzip compressed manifest at the version and its last modified date, by applying the changes to the
+        data of the since version, rebuilt when there is no data or the changes since its version are purged
+        """
+        RouteChange = self.env['alokai.route.change']
+        if data and since >= RouteChange._get_oldest_version():
+            manifest = json.loads(gzip.decompress(data))
+            for res_model, ids in RouteChange._get_changes(since, version).items():
+                section = manifest[ROUTE_MODELS[res_model][0]]
+                for record_id in ids:
+                    section.pop(str(record_id), None)
+                section.update(self._read_routes(res_model, website, lang, ids))
+        else:
+            manifest = {
+                section: self._read_routes(res_model, website, lang)
+                for res_model, (section, __) in ROUTE_MODELS.items()
+            }
+
+        last_modified = fields.Datetime.now()
+        manifest.update({
+            'version': version,
+            'website_id': website.id,
+            'lang': lang,
+            'last_modified': last_modified.isoformat(),
+        })
+        return gzip.compress(json.dumps(manifest, separators=(',', ':')).encode()), last_modified
+
+    def _refresh(self):
+        """ Bring the stored manifest up to the current version """
+        self.ensure_one()
+        version = self.env['alokai.route.change']._get_version()
+        data = self._load()
+        if data and self.version == version:
+            return
+
+        data, last_modified = self._build(self.website_id, self.lang, data, self.version, version)
+        self.env.cr.execute("""
+            UPDATE alokai_route_manifest
+            SET data = %s, version = %s, last_modified = %s, write_date = %s
+            WHERE id = %s;
+        """, (data, version, last_modified, last_modified, self.id))
+        self.invalidate_recordset(['data', 'version', 'last_modified', 'write_date'])
+
+    @api.model
+    def _get_manifest(self, website, lang):
+        """
+        Return the gzip compressed manifest of the website and language, its version and last modified date.
+        The manifests are stored at the current version by the cron assigning the versions. A manifest missing or
+        not refreshed yet is built once per worker and version, and the refresh cron is triggered to store it.
+        """
+        version = self.env['alokai.route.change']._get_version()
+        manifest = self.search([('website_id', '=', website.id), ('lang', '=', lang)], limit=1)
+        if manifest and manifest.version == version:
+            data = manifest._load()
+            if data:
+                return data, version, manifest.last_modified
+
+        key = (self.env.cr.dbname, website.id, lang, version)
+        built = route_manifest_cache.get(key)
+        if built is None:
+            data = manifest and manifest._load()
+            built = self._build(website, lang, data, manifest.version if data else 0, version)
+            route_manifest_cache[key] = built
+            self.env.ref('graphql_alokai.ir_cron_refresh_route_manifests')._trigger()
+        data, last_modified = built
+        return data, version, last_modified
+
+    @api.model
+    def _get_delta(self, website, lang, since):
+        """ Return the routes changed after the since version, None routes are removed, or None if purged """
+        RouteChange = self.env['alokai.route.change']
+        if since < RouteChange._get_oldest_version():
+            return None
+
+        version = RouteChange._get_version()
+        delta = {section: {} for section, __ in ROUTE_MODELS.values()}
+        for res_model, ids in RouteChange._get_changes(since, version).items():
+            section = delta[ROUTE_MODELS[res_model][0]]
+            section.update(dict.fromkeys((str(record_id) for record_id in ids), None))
+            section.update(self._read_routes(res_model, website, lang, ids))
+
+        delta.update({
+            'version': version,
+            'since': since,
+            'website_id': website.id,
+            'lang': lang,
+        })
+        return delta
+
+    @api.model
+    def _refresh_manifests(self):
+        """
+        Version the new route changes and bring the manifests of every website and language to that version in the
+        same transaction, so the storefront build is always served stored manifests
+        """
+        RouteChange = self.env['alokai.route.change']
+        RouteChange._assign_version()
+        RouteChange._purge_changes()
+        manifests = self.search([])
+        existing = {(manifest.website_id.id, manifest.lang) for manifest in manifests}
+        manifests |= self.create([
+            {'website_id': website.id, 'lang': lang}
+            for website in self.env['website'].search([])
+            for lang in website.language_ids.mapped('code')
+            if (website.id, lang) not in existing
+        ])
+        for manifest in manifests:
+            manifest._refresh()
@@ -2,22 +2,87 @@
 # Copyright 2025 ERPGAP/PROMPTEQUATION LDA
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
 
-from odoo import models, api, _
+import logging
+
+from odoo import models, fields, api, SUPERUSER_ID, _
+from odoo.exceptions import UserError
+from redis.exceptions import RedisError
+
+from .product import STOCK_DIRTY_REDIS_KEY
+from .website import redis_circuit_breaker
+
+_logger = logging.getLogger(__name__)
+
+
+class ProductStockDirty(models.Model):
+    """ Products whose stock changed while Redis was unavailable, moved to the Redis dirty set by the stock sync """
+    _name = 'product.stock.dirty'
+    _description = 'Alokai Dirty Product Stock'
+
+    product_id = fields.Integer('Product ID', required=True)
+
+    def init(self):
+        super().init()
+        self.env.cr.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS product_stock_dirty_product_uniq
+            ON product_stock_dirty(product_id);
+        """)
+
+    @api.model
+    def _enqueue(self, product_ids):
+        self.env.cr.execute("""
+            INSERT INTO product_stock_dirty(product_id, create_date, write_date, create_uid, write_uid)
+            SELECT product_id, NOW() AT TIME ZONE 'UTC', NOW() AT TIME ZONE 'UTC', %s, %s
+            FROM unnest(%s::int[]) AS product_id
+            ON CONFLICT (product_id) DO NOTHING;
+        """, (self.env.uid, self.env.uid, list(product_ids)))
+
+    @api.model
+    def _move_to_redis(self, redis_client):
+        """ Move the queued products to the Redis dirty set, the rows are restored by the rollback on failure """
+        self.env.cr.execute("DELETE FROM product_stock_dirty RETURNING product_id;")
+        product_ids = [row[0] for row in self.env.cr.fetchall()]
+        if product_ids:
+            redis_client.sadd(STOCK_DIRTY_REDIS_KEY, *product_ids)
+        self.env.cr.commit()
 
 
 class StockQuant(models.Model):
     _inherit = 'stock.quant'
 
     def _create_stock_is_dirty_redis(self):
-        redis_client = self.env['website']._redis_connect()
-        pipe = redis_client.pipeline()
+        """
+        Collect the products of the transaction, they are added to the Redis dirty set once after the commit.
+        When Redis is not available, the products are queued in Postgres within the transaction.
+        """
+        product_ids = self.mapped('product_id').ids
+        if not product_ids:
+            return
+
+        data = self.env.cr.postcommit.data
+        dirty_ids = data.get(STOCK_DIRTY_REDIS_KEY)
+        if dirty_ids is None:
+            try:
+                redis_client = self.env['website']._redis_connect()
+            except UserError:
+                self.env['product.stock.dirty']._enqueue(product_ids)
+                return
+
+            dirty_ids = data[STOCK_DIRTY_REDIS_KEY] = set()
+            registry = self.env.registry
 
-        for quant in self:
-            product_id = quant.product_id.id
-            product_key = f'product-stock-is-dirty-{product_id}'
-            pipe.set(product_key, product_id)
+            @self.env.cr.postcommit.add
+            def flush_stock_is_dirty_redis():
+                try:
+                    redis_client.sadd(STOCK_DIRTY_REDIS_KEY, *dirty_ids)
+                    redis_circuit_breaker.record_success()
+                except RedisError as e:
+                    redis_circuit_breaker.record_failure()
+                    _logger.warning('Redis unavailable, stock changes queued: %s', e)
+                    with registry.cursor() as cr:
+                        api.Environment(cr, SUPERUSER_ID, {})['product.stock.dirty']._enqueue(dirty_ids)
 
-        pipe.execute()
+        dirty_ids.update(product_ids)
 
     def write(self, vals):
         res = super(StockQuant, self).write(vals)
@@ -4,15 +4,84 @@
 import redis
 import pprint
 import json
-import requests
-from odoo import models, fields, api
+import threading
+import time
+from odoo import models, fields, api, tools
 from odoo.exceptions import ValidationError
 from odoo import _
 from odoo.addons.graphql_alokai.schemas.objects import get_image_url
 from odoo.osv import expression
+from odoo.tools import split_every
 from odoo.exceptions import UserError
 from redis.exceptions import TimeoutError, AuthenticationError, ConnectionError
 
+REDIS_HEALTH_CHECK_INTERVAL = 30
+REDIS_CIRCUIT_FAILURES = 3
+REDIS_CIRCUIT_COOLDOWN = 30
+# Keys kept by the flush of the storefront cache, and key set by the flush button for the flush cron
+REDIS_FLUSH_KEEP_PREFIXES = ('cart:', 'stock:', 'product-stock-')
+REDIS_FLUSH_REQUEST_KEY = 'alokai:flush-requested'
+
+_redis_pools = {}
+_redis_pools_lock = threading.Lock()
+
+
+def get_redis_pool(host, port, db, unix_socket):
+    """ Process wide connection pool per Redis server, the connections are opened lazily and health checked """
+    key = (host, port, db, unix_socket)
+    with _redis_pools_lock:
+        pool = _redis_pools.get(key)
+        if pool is None:
+            if unix_socket:
+                pool = redis.ConnectionPool(
+                    connection_class=redis.UnixDomainSocketConnection,
+                    path=unix_socket,
+                    db=db,
+                    socket_timeout=1.0,
+                    decode_responses=True,
+                    health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+                )
+            else:
+                pool = redis.ConnectionPool(
+                    host=host,
+                    port=port,
+                    db=db,
+                    socket_timeout=1.0,
+                    socket_connect_timeout=1.0,
+                    decode_responses=True,
+                    health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+                )
+            _redis_pools[key] = pool
+    return pool
+
+
+class RedisCircuitBreaker(object):
+    """
+    Stop calling Redis for a cooldown period after consecutive failures, so the callers having a fallback do not
+    wait for the socket timeout on every call while Redis is down
+    """
+
+    def __init__(self, max_failures=REDIS_CIRCUIT_FAILURES, cooldown=REDIS_CIRCUIT_COOLDOWN):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0
+
+    def is_open(self):
+        return time.monotonic() < self.open_until
+
+    def record_success(self):
+        self.failures = 0
+        self.open_until = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.max_failures:
+            self.open_until = time.monotonic() + self.cooldown
+
+
+redis_circuit_breaker = RedisCircuitBreaker()
+
 
 class WebsiteSeoMetadata(models.AbstractModel):
     _inherit = 'website.seo.metadata'
@@ -110,24 +179,27 @@ class Website(models.Model):
 
     @api.model
     def _redis_connect(self):
-        ICP = self.env['ir.config_parameter'].sudo()
-        redis_host = ICP.get_param('alokai_redis_host', False)
-        redis_port = ICP.get_param('alokai_redis_port', False)
-
-        if not redis_host or not redis_port:
+        """ Return a client of the process wide connection pool, the connection is only opened by the first command """
+        settings = self.env['alokai.settings']
+        redis_host = settings.get('alokai_redis_host')
+        redis_port = settings.get('alokai_redis_port')
+        redis_db = settings.get('alokai_redis_db')
+        redis_unix_socket = settings.get('alokai_redis_unix_socket')
+
+        if not redis_unix_socket and (not redis_host or not redis_port):
             raise UserError(_('Please configure Redis.'))
 
+        if redis_circuit_breaker.is_open():
+            raise UserError(_('Unable to connect to Redis.'))
+
+        pool = get_redis_pool(redis_host, redis_port, redis_db, redis_unix_socket)
+        return redis.Redis(connection_pool=pool)
+
+    @api.model
+    def _redis_check_connection(self):
+        """ Ping Redis, raising a UserError describing the failure """
         try:
-            redis_client = redis.Redis(
-                host=redis_host,
-                port=redis_port,
-                socket_timeout=1.0,
-                socket_connect_timeout=1.0,
-                decode_responses=True,
-            )
-            redis_client.ping()
-
-            return redis_client
+            self._redis_connect().ping()
         except TimeoutError:
             raise UserError(_('Timeout while connecting to Redis.'))
         except AuthenticationError:
@@ -137,45 +209,74 @@ class Website(models.Model):
 
     def redis_flushdb(self):
         """
-        Deletes all keys from a Redis database except those matching specified patterns.
-        SCAN iterates over keys in batches without blocking Redis.
-        The loop ends when the cursor returned by SCAN is 0, indicating all keys have been scanned.
+        Flush the Redis cache. The GraphQL responses of the website are invalidated at once by incrementing its cache
+        generation, the storefront keys are deleted in background by the Redis flush cron.
         """
         self.ensure_one()
 
-        # Keep cart and stock keys in redis
-        patterns_to_keep = ['cart:*', 'stock:*', 'product-stock-*', 'product-stock-is-dirty-*']
-        batch_size = 100
-
-        redis_client = self._redis_connect()
-
-        cursor = 0
-        while True:
-            cursor, keys = redis_client.scan(cursor, match='*', count=batch_size)
-
-            keys_to_delete = []
-            for key in keys:
-                if not any(key.startswith(pattern[:-1]) for pattern in patterns_to_keep):
-                    keys_to_delete.append(key)
-
-            if keys_to_delete:
-                redis_client.delete(*keys_to_delete)
-
-            if cursor == 0:
-                break
+        self._redis_check_connection()
+        self.env['alokai.graphql.cache']._flush(self.ids)
+        self._redis_connect().set(REDIS_FLUSH_REQUEST_KEY, 1)
+        self.env.ref('graphql_alokai.ir_cron_redis_flush')._trigger()
 
         return {
             'type': 'ir.actions.client',
             'tag': 'display_notification',
             'params': {
-                'title': _('Redis flushed'),
-                'message': _('Redis cache has been successfully flushed.'),
+                'title': _('Redis flush scheduled'),
+                'message': _('The GraphQL responses have been invalidated, the other cached keys are being deleted '
+                             'in background.'),
                 'type': 'success',
                 'sticky': False,
                 'fadeout': 'slow',
             },
         }
 
+    @api.model
+    def _redis_is_configured(self):
+        settings = self.env['alokai.settings']
+        return bool(settings.get('alokai_redis_unix_socket') or settings.get('alokai_redis_host'))
+
+    @api.model
+    def _redis_unlink(self, redis_client, match, prefixes_to_keep):
+        """
+        Delete the keys matching the pattern, but those starting with one of the prefixes to keep. SCAN iterates over
+        the keys without blocking Redis and UNLINK reclaims the memory in background.
+        """
+        for keys in split_every(1000, redis_client.scan_iter(match=match, count=1000), list):
+            keys_to_delete = [key for key in keys if not key.startswith(prefixes_to_keep)]
+            if keys_to_delete:
+                redis_client.unlink(*keys_to_delete)
+
+    @api.model
+    def _redis_flush(self):
+        """
+        Delete from Redis all keys but the cart, the stock and the current generations of the response cache, when
+        a flush was requested with the flush button since the last run
+        """
+        if not self._redis_is_configured():
+            return
+
+        redis_client = self._redis_connect()
+        if not redis_client.delete(REDIS_FLUSH_REQUEST_KEY):
+            return
+
+        prefixes_to_keep = REDIS_FLUSH_KEEP_PREFIXES + (REDIS_FLUSH_REQUEST_KEY,) + tuple(
+            self.env['alokai.graphql.cache']._get_keep_prefixes(redis_client))
+        self._redis_unlink(redis_client, '*', prefixes_to_keep)
+
+    @api.model
+    def _redis_sweep(self):
+        """ Delete the GraphQL response cache keys of the previous generations, the other keys are left untouched """
+        if not self._redis_is_configured():
+            return
+
+        GraphqlCache = self.env['alokai.graphql.cache']
+        redis_client = self._redis_connect()
+        prefixes_to_keep = tuple(GraphqlCache._get_keep_prefixes(redis_client))
+        for prefix in (GraphqlCache._key_prefix, GraphqlCache._tag_prefix):
+            self._redis_unlink(redis_client, f'{prefix}*', prefixes_to_keep)
+
     alokai_payment_success_return_url = fields.Char(
         'Payment Success Return Url', required=True, translate=True, default='Dummy'
     )
@@ -197,36 +298,63 @@ class Website(models.Model):
         ICP.set_param('auth_signup.invitation_scope', 'b2c')
         ICP.set_param('auth_signup.reset_password', True)
 
+    @api.model
+    @tools.ormcache()
+    def _get_alokai_website_contexts(self):
+        """
+        Return {domain: (website id, language code, public user id)}, with the context of the requests of unknown
+        hosts under None. A single entry is cached per process, the request host is sent by the clients.
+        """
+        contexts = {}
+        for website in self.sudo().search([]):
+            context = (website.id, website.default_lang_id.code, website.user_id.id)
+            contexts.setdefault(None, context)
+            if website.domain:
+                contexts.setdefault(website.domain, context)
+        return tools.frozendict(contexts)
 
-class WebsiteRewrite(models.Model):
-    _inherit = 'website.rewrite'
+    @api.model
+    def _get_alokai_website_context(self, request_host):
+        """ Return the website id, language code and public user id of a request host """
+        contexts = self._get_alokai_website_contexts()
+        return contexts.get(request_host) or contexts.get(None) or (False, False, False)
 
-    def _get_alokai_tags(self):
-        tags = 'WR%s' % self.id
-        return tags
+    @api.model_create_multi
+    def create(self, vals_list):
+        websites = super(Website, self).create(vals_list)
+        self.env.registry.clear_cache()
+        return websites
 
-    def _alokai_request_cache_invalidation(self):
-        ICP = self.env['ir.config_parameter'].sudo()
-        url = ICP.get_param('alokai_cache_invalidation_url', False)
-        key = ICP.get_param('alokai_cache_invalidation_key', False)
+    def write(self, vals):
+        res = super(Website, self).write(vals)
+        if {'domain', 'default_lang_id', 'user_id', 'sequence'} & set(vals):
+            self.env.registry.clear_cache()
+        return res
 
-        if url and key:
-            try:
-                for website_rewrite in self:
-                    tags = website_rewrite._get_alokai_tags()
+    def unlink(self):
+        res = super(Website, self).unlink()
+        self.env.registry.clear_cache()
+        return res
 
-                    # Make the GET request to the /cache-invalidate
-                    requests.get(url, params={'key': key, 'tags': tags}, timeout=5)
-            except:
-                pass
+
+class WebsiteRewrite(models.Model):
+    _inherit = 'website.rewrite'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        rewrites = super(WebsiteRewrite, self).create(vals_list)
+        self.env['alokai.route.change']._record_changes(self._name, rewrites.ids)
+        return rewrites
 
     def write(self, vals):
         res = super(WebsiteRewrite, self).write(vals)
-        self._alokai_request_cache_invalidation()
+        self.env['invalidate.cache'].create_invalidate_cache(self._name, self.ids)
+        self.env['alokai.route.change']._record_changes(self._name, self.ids, vals)
         return res
 
     def unlink(self):
-        self._alokai_request_cache_invalidation()
+        self.env['invalidate.cache'].create_invalidate_cache(self._name, self.ids)
+        self.env['alokai.route.change']._record_changes(self._name, self.ids)
         return super(WebsiteRewrite, self).unlink()
 
 
@@ -3,9 +3,12 @@
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
 
 import graphene
+from odoo.osv import expression
 
 from odoo.addons.graphql_alokai.schemas.objects import (
-    SortEnum, Category
+    SortEnum, Category,
+    get_next_search_cursor,
+    get_search_cursor_domain
 )
 
 
@@ -34,6 +37,7 @@ class CategorySortInput(graphene.InputObjectType):
 class Categories(graphene.Interface):
     categories = graphene.List(Category)
     total_count = graphene.Int(required=True)
+    next_cursor = graphene.String()
 
 
 class CategoryList(graphene.ObjectType):
@@ -53,7 +57,9 @@ class CategoryQuery(graphene.ObjectType):
         current_page=graphene.Int(default_value=1),
         page_size=graphene.Int(default_value=20),
         search=graphene.String(default_value=False),
-        sort=graphene.Argument(CategorySortInput, default_value={})
+        sort=graphene.Argument(CategorySortInput, default_value={}),
+        after=graphene.String(default_value=None),
+        first=graphene.Int(default_value=None)
     )
 
     @staticmethod
@@ -75,7 +81,7 @@ class CategoryQuery(graphene.ObjectType):
         return category
 
     @staticmethod
-    def resolve_categories(self, info, filter, current_page, page_size, search, sort):
+    def resolve_categories(self, info, filter, current_page, page_size, search, sort, after=None, first=None):
         env = info.context["env"]
         order = get_search_order(sort)
         domain = env['website'].get_current_website().website_domain()
@@ -99,6 +105,14 @@ class CategoryQuery(graphene.ObjectType):
 
         ProductPublicCategory = env["product.public.category"]
         total_count = ProductPublicCategory.search_count(domain)
+
+        # Keyset pagination, the cursor replaces the offset
+        if after or first:
+            page_size = first or page_size
+            offset = 0
+            domain = expression.AND([domain, get_search_cursor_domain(ProductPublicCategory, order, after)])
+
         categories = ProductPublicCategory.search(
             domain, limit=page_size, offset=offset, order=order)
-        return CategoryList(categories=categories, total_count=total_count)
+        next_cursor = get_next_search_cursor(categories, order, page_size)
+        return CategoryList(categories=categories, total_count=total_count, next_cursor=next_cursor)
@@ -3,9 +3,12 @@
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
 
 import graphene
+from odoo.osv import expression
 
 from odoo.addons.graphql_alokai.schemas.objects import (
-    SortEnum, Country
+    SortEnum, Country,
+    get_next_search_cursor,
+    get_search_cursor_domain
 )
 
 
@@ -36,6 +39,7 @@ class CountrySortInput(graphene.InputObjectType):
 class Countries(graphene.Interface):
     countries = graphene.List(Country)
     total_count = graphene.Int(required=True)
+    next_cursor = graphene.String()
 
 
 class CountryList(graphene.ObjectType):
@@ -56,7 +60,9 @@ class CountryQuery(graphene.ObjectType):
         current_page=graphene.Int(default_value=1),
         page_size=graphene.Int(default_value=20),
         search=graphene.String(default_value=False),
-        sort=graphene.Argument(CountrySortInput, default_value={})
+        sort=graphene.Argument(CountrySortInput, default_value={}),
+        after=graphene.String(default_value=None),
+        first=graphene.Int(default_value=None)
     )
 
     @staticmethod
@@ -69,7 +75,7 @@ class CountryQuery(graphene.ObjectType):
         return info.context['env']['res.country'].search(domain, limit=1)
 
     @staticmethod
-    def resolve_countries(self, info, filter, current_page, page_size, search, sort):
+    def resolve_countries(self, info, filter, current_page, page_size, search, sort, after=None, first=None):
         env = info.context["env"]
         order = get_search_order(sort)
         domain = []
@@ -89,5 +95,13 @@ class CountryQuery(graphene.ObjectType):
 
         Country = env["res.country"]
         total_count = Country.search_count(domain)
+
+        # Keyset pagination, the cursor replaces the offset
+        if after or first:
+            page_size = first or page_size
+            offset = 0
+            domain = expression.AND([domain, get_search_cursor_domain(Country, order, after)])
+
         countries = Country.search(domain, limit=page_size, offset=offset, order=order)
-        return CountryList(countries=countries, total_count=total_count)
+        next_cursor = get_next_search_cursor(countries, order, page_size)
+        return CountryList(countries=countries, total_count=total_count, next_cursor=next_cursor)
@@ -5,12 +5,15 @@
 import graphene
 from graphql import GraphQLError
 from odoo.http import request
+from odoo.osv import expression
 from odoo import _
 
 from odoo.addons.graphql_alokai.schemas.objects import (
     SortEnum, Invoice,
     get_document_with_check_access,
-    get_document_count_with_check_access
+    get_document_count_with_check_access,
+    get_next_search_cursor,
+    get_search_cursor_domain
 )
 
 
@@ -40,6 +43,7 @@ class InvoiceSortInput(graphene.InputObjectType):
 class Invoices(graphene.Interface):
     invoices = graphene.List(Invoice)
     total_count = graphene.Int(required=True)
+    next_cursor = graphene.String()
 
 
 class InvoiceList(graphene.ObjectType):
@@ -57,7 +61,9 @@ class InvoiceQuery(graphene.ObjectType):
         Invoices,
         current_page=graphene.Int(default_value=1),
         page_size=graphene.Int(default_value=10),
-        sort=graphene.Argument(InvoiceSortInput, default_value={})
+        sort=graphene.Argument(InvoiceSortInput, default_value={}),
+        after=graphene.String(default_value=None),
+        first=graphene.Int(default_value=None)
     )
 
     @staticmethod
@@ -70,7 +76,7 @@ class InvoiceQuery(graphene.ObjectType):
         return invoice.sudo()
 
     @staticmethod
-    def resolve_invoices(self, info, current_page, page_size, sort):
+    def resolve_invoices(self, info, current_page, page_size, sort, after=None, first=None):
         env = info.context["env"]
         user = request.env.user
         partner = user.partner_id
@@ -86,7 +92,16 @@ class InvoiceQuery(graphene.ObjectType):
             offset = 0
 
         AccountMove = env["account.move"]
+        total_count = get_document_count_with_check_access(AccountMove, domain)
+
+        # Keyset pagination, the cursor replaces the offset
+        if after or first:
+            page_size = first or page_size
+            offset = 0
+            domain = expression.AND([domain, get_search_cursor_domain(AccountMove, sort_order, after)])
+
         invoices = get_document_with_check_access(AccountMove, domain, sort_order, page_size, offset,
                                                   error_msg='Invoice does not exist.')
-        total_count = get_document_count_with_check_access(AccountMove, domain)
-        return InvoiceList(invoices=invoices and invoices.sudo() or invoices, total_count=total_count)
+        next_cursor = get_next_search_cursor(invoices, sort_order, page_size)
+        return InvoiceList(invoices=invoices and invoices.sudo() or invoices, total_count=total_count,
+                           next_cursor=next_cursor)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+from odoo.models import PREFETCH_MAX
+
+
+class RecordLoader(object):
+    """
+    Per request registry that batches the lookups done by the resolvers.
+
+    GraphQL resolves a list field record by record. Instead of reading a relation on a single record, the loader reads
+    it at once for every sibling record of the same level of the query tree (the records sharing the prefetch set of
+    the resolved record) and keeps the result for the rest of the request. The records returned by the loader share
+    one prefetch set as well, so the next level of the query tree is batched too.
+    """
+
+    def __init__(self):
+        self._values = {}
+
+    def load(self, record, key, batch_load):
+        """
+        Return the value of `key` for `record`.
+        `batch_load` receives the records to load and returns a dictionary {record id: value}.
+        """
+        values = self._values.setdefault((record._name, key, record.env.su), {})
+
+        if record.id not in values:
+            ids = [record.id]
+            for record_id in record._prefetch_ids:
+                if len(ids) >= PREFETCH_MAX:
+                    break
+                if record_id != record.id and record_id not in values:
+                    ids.append(record_id)
+
+            values.update(batch_load(record.browse(ids)))
+
+        return values.get(record.id)
+
+    def load_relation(self, record, field_name):
+        """ Return the records of a relational field, reading the field with one read() for the whole level """
+        field = record._fields[field_name]
+        comodel = record.env[field.comodel_name]
+
+        def batch_load(records):
+            rows = records.read([field_name], load=None)
+
+            if field.type == 'many2one':
+                rows_ids = {row['id']: [row[field_name]] if row[field_name] else [] for row in rows}
+            else:
+                rows_ids = {row['id']: row[field_name] for row in rows}
+
+            prefetch_ids = list(dict.fromkeys(id_ for ids in rows_ids.values() for id_ in ids))
+            return {
+                record_id: comodel.browse(ids).with_prefetch(prefetch_ids)
+                for record_id, ids in rows_ids.items()
+            }
+
+        return self.load(record, field_name, batch_load)
+
+    def load_free_qty(self, record):
+        """ Return the free quantity of a product, for a template this is the sum of its variants """
+        def batch_load(records):
+            if records._name == 'product.template':
+                variants = records.mapped('product_variant_ids')
+                free_qty = {variant.id: variant.free_qty for variant in variants}
+                return {
+                    template.id: sum(free_qty.get(variant_id, 0) for variant_id in template.product_variant_ids.ids)
+                    for template in records
+                }
+            return {product.id: product.free_qty for product in records}
+
+        return self.load(record, 'free_qty', batch_load)
+
+    def load_stock_qty(self, record):
+        """
+        Return the free quantity of a product in the warehouse of the current website, as mirrored by the Redis stock
+        sync, computed in that same warehouse for the products that were not synced yet
+        """
+        website_id = record.env.context.get('website_id')
+        if not website_id:
+            return self.load_free_qty(record)
+
+        stock_model = {
+            'product.template': 'product.template.redis_stock',
+            'product.product': 'product.product.redis_stock',
+        }[record._name]
+        table = record.env[stock_model]._table
+
+        def batch_load(records):
+            record.env.cr.execute(
+                f"SELECT product_id, quantity FROM {table} WHERE website_id = %s AND product_id = ANY(%s)",
+                (website_id, records.ids),
+            )
+            quantities = {product_id: float(quantity) for product_id, quantity in record.env.cr.fetchall()}
+            missing = records.browse([record_id for record_id in records.ids if record_id not in quantities])
+            if missing:
+                quantities.update(self._get_website_free_qty(missing, website_id))
+            return quantities
+
+        return self.load(record, ('stock_qty', website_id), batch_load)
+
+    def _get_website_free_qty(self, records, website_id):
+        """ Return {product id: free quantity in the warehouse of the website}, for a template the sum of its variants """
+        Product = records.env['product.product'].sudo()
+        website = records.env['website'].sudo().browse(website_id)
+        warehouse_id = Product._get_website_warehouses(website)[website_id]
+
+        variants = records.mapped('product_variant_ids') if records._name == 'product.template' else records
+        free_qty = {}
+        if warehouse_id:
+            records.env['stock.quant'].flush_model(['product_id', 'location_id', 'quantity', 'reserved_quantity'])
+            free_qty = Product.browse(variants.ids)._get_free_qty_by_warehouse([warehouse_id])
+
+        def get_free_qty(product_id):
+            return float(free_qty.get((product_id, warehouse_id), 0.0))
+
+        if records._name == 'product.template':
+            return {
+                template.id: sum(get_free_qty(variant_id) for variant_id in template.product_variant_ids.ids)
+                for template in records
+            }
+        return {product.id: get_free_qty(product.id) for product in records}
+
+
+def get_record_loader(info):
+    """ The loader lives in the GraphQL context, so it is shared by all resolvers of the same request """
+    loader = info.context.get('record_loader')
+    if loader is None:
+        loader = info.context['record_loader'] = RecordLoader()
+    return loader
+
+
+def load_relation(info, record, field_name):
+    return get_record_loader(info).load_relation(record, field_name)
+
+
+def load_stock_qty(info, record):
+    return get_record_loader(info).load_stock_qty(record)
@@ -6,9 +6,12 @@ import graphene
 from graphql import GraphQLError
 from odoo.http import request
 from odoo import _
+from odoo.osv import expression
 from odoo.addons.website_mass_mailing.controllers.main import MassMailController
 from odoo.addons.graphql_alokai.schemas.objects import (
-    SortEnum, MailingContact, MailingList
+    SortEnum, MailingContact, MailingList,
+    get_next_search_cursor,
+    get_search_cursor_domain
 )
 
 
@@ -43,6 +46,7 @@ class MailingContactSortInput(graphene.InputObjectType):
 class MailingContacts(graphene.Interface):
     mailing_contacts = graphene.List(MailingContact)
     total_count = graphene.Int(required=True)
+    next_cursor = graphene.String()
 
 
 class MailingContactList(graphene.ObjectType):
@@ -57,11 +61,13 @@ class MailingContactQuery(graphene.ObjectType):
         current_page=graphene.Int(default_value=1),
         page_size=graphene.Int(default_value=20),
         search=graphene.String(default_value=False),
-        sort=graphene.Argument(MailingContactSortInput, default_value={})
+        sort=graphene.Argument(MailingContactSortInput, default_value={}),
+        after=graphene.String(default_value=None),
+        first=graphene.Int(default_value=None)
     )
 
     @staticmethod
-    def resolve_mailing_contacts(self, info, filter, current_page, page_size, search, sort):
+    def resolve_mailing_contacts(self, info, filter, current_page, page_size, search, sort, after=None, first=None):
         env = info.context['env']
         order = get_search_order(sort)
 
@@ -82,8 +88,17 @@ class MailingContactQuery(graphene.ObjectType):
 
         MailingContact = env['mailing.contact'].sudo()
         total_count = MailingContact.search_count(domain)
+
+        # Keyset pagination, the cursor replaces the offset
+        if after or first:
+            page_size = first or page_size
+            offset = 0
+            domain = expression.AND([domain, get_search_cursor_domain(MailingContact, order, after)])
+
         mailing_contacts = MailingContact.search(domain, limit=page_size, offset=offset, order=order)
-        return MailingContactList(mailing_contacts=mailing_contacts, total_count=total_count)
+        next_cursor = get_next_search_cursor(mailing_contacts, order, page_size)
+        return MailingContactList(mailing_contacts=mailing_contacts, total_count=total_count,
+                                  next_cursor=next_cursor)
 
 
 # --------------------- #
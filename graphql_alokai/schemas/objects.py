@@ -2,15 +2,21 @@
 # Copyright 2024 ERPGAP/PROMPTEQUATION LDA
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
 
+import base64
+import json
+from datetime import datetime
+
 import graphene
 from graphene.types import generic
 from graphql import GraphQLError
-from odoo import SUPERUSER_ID, _
+from odoo import SUPERUSER_ID, _, fields, models
 
 from odoo.addons.graphql_base import OdooObjectType
 from odoo.exceptions import AccessError
 from odoo.http import request
+from odoo.osv import expression
 from odoo.addons.auth_totp.controllers.home import TRUSTED_DEVICE_COOKIE
+from odoo.addons.graphql_alokai.schemas.loaders import load_relation, load_stock_qty
 
 
 # --------------------- #
@@ -76,6 +82,87 @@ def get_document_count_with_check_access(model, domain):
     return model.search_count(domain)
 
 
+def get_search_order_fields(order):
+    """ Split a search order like 'name DESC, id ASC' into a list of (field, direction) """
+    order_fields = []
+    for order_part in order.split(','):
+        order_part = order_part.strip().split()
+        if not order_part:
+            continue
+        direction = order_part[1].upper() if len(order_part) > 1 else 'ASC'
+        order_fields.append((order_part[0], direction))
+    return order_fields
+
+
+def get_next_search_cursor(records, order, limit):
+    """
+    Cursor pointing after the last record of a page, or None on the last page.
+    The cursor holds the values of the order fields of that record, the order always ends with the id so it is unique.
+    """
+    if not records or not limit or len(records) < limit:
+        return None
+
+    record = records[-1]
+    values = []
+    for field_name, direction in get_search_order_fields(order):
+        field = record._fields[field_name]
+        value = record[field_name]
+        if isinstance(value, models.BaseModel):
+            value = value.id or None
+        elif field.type == 'datetime':
+            # Full precision, create_date and write_date have microseconds
+            value = value and value.isoformat() or None
+        elif field.type == 'date':
+            value = value and fields.Date.to_string(value) or None
+        elif field.type != 'boolean' and value is False:
+            value = None
+        values.append(value)
+
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def get_search_cursor_domain(model, order, cursor):
+    """
+    Keyset pagination: domain of the records of the model coming after the cursor in the given order.
+    Postgres sorts NULL values last in ascending order and first in descending order.
+    """
+    if not cursor:
+        return []
+
+    order_fields = get_search_order_fields(order)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, TypeError):
+        raise GraphQLError(_('Invalid cursor.'))
+    if not isinstance(values, list) or len(values) != len(order_fields):
+        raise GraphQLError(_('Invalid cursor.'))
+
+    # The datetime values are compared as datetime, a string would be truncated to the second by the domain
+    for index, (field_name, __) in enumerate(order_fields):
+        field = model._fields.get(field_name)
+        if field and field.type == 'datetime' and values[index] is not None:
+            try:
+                values[index] = datetime.fromisoformat(values[index])
+            except (ValueError, TypeError):
+                raise GraphQLError(_('Invalid cursor.'))
+
+    domains = []
+    equal_domain = []
+    for (field_name, direction), value in zip(order_fields, values):
+        if direction == 'DESC':
+            after_domain = [(field_name, '!=', False)] if value is None else [(field_name, '<', value)]
+        elif value is not None:
+            after_domain = ['|', (field_name, '>', value), (field_name, '=', False)]
+        else:
+            after_domain = None
+
+        if after_domain:
+            domains.append(expression.AND([equal_domain, after_domain]))
+        equal_domain = expression.AND([equal_domain, [(field_name, '=', False if value is None else value)]])
+
+    return expression.OR(domains) if domains else expression.FALSE_DOMAIN
+
+
 def get_product_pricing_info(product):
     if product and product._name == 'product.template':
         return product and product._get_combination_info() or None
@@ -86,6 +173,17 @@ def product_is_in_wishlist(env, product):
     return product._is_in_wishlist()
 
 
+def get_image_unique_id(object):
+    """ Return the hexadecimal write_date timestamp of the record, the version of its image urls """
+    try:
+        timestamp = int(object.write_date.timestamp())
+    except (AttributeError, ValueError):
+        return None
+
+    # Remove '0x' prefix
+    return hex(timestamp)[2:]
+
+
 def get_image_filename(object, name='name'):
     """
     Uses write_date timestamp as an unique identifier on the asset. This will make sure we keep it on cache (CDN,
@@ -93,14 +191,10 @@ def get_image_filename(object, name='name'):
     """
     image_name = object.env['ir.http']._slugify(getattr(object, name, '') or '')
 
-    try:
-        timestamp = int(object.write_date.timestamp())
-    except ValueError as e:
+    unique_id = get_image_unique_id(object)
+    if not unique_id:
         return 'image'
 
-    # Remove '0x' prefix
-    unique_id = hex(timestamp)[2:]
-
     if image_name:
         return f'{unique_id}_{image_name}'
     return unique_id
@@ -336,16 +430,16 @@ class Category(OdooObjectType):
         return get_image_filename(self)
 
     def resolve_parent(self, info):
-        return self.parent_id or None
+        return load_relation(info, self, 'parent_id') or None
 
     def resolve_childs(self, info):
-        return self.child_id or None
+        return load_relation(info, self, 'child_id') or None
 
     def resolve_slug(self, info):
         return self.website_slug
 
     def resolve_products(self, info):
-        return self.product_tmpl_ids or None
+        return load_relation(info, self, 'product_tmpl_ids') or None
 
     def resolve_meta_title(self, info):
         return self.website_meta_title or None
@@ -509,11 +603,7 @@ class Product(OdooObjectType):
             return 0
 
     def resolve_status(self, info):
-        free_qty = 0
-        if self._name == 'product.template':
-            free_qty = sum(self.product_variant_ids.mapped('free_qty'))
-        else:
-            free_qty = self.free_qty
+        free_qty = load_stock_qty(info, self)
         if free_qty > 0:
             return 1
         else:
@@ -526,7 +616,7 @@ class Product(OdooObjectType):
         return self.description_sale or None
 
     def resolve_currency(self, info):
-        return self.currency_id or None
+        return load_relation(info, self, 'currency_id') or None
 
     def resolve_meta_title(self, info):
         return self.website_meta_title or None
@@ -554,10 +644,11 @@ class Product(OdooObjectType):
 
     def resolve_categories(self, info):
         website = self.env['website'].get_current_website()
+        categories = load_relation(info, self, 'public_categ_ids')
         if website:
-            return self.public_categ_ids.filtered(
+            return categories.filtered(
                 lambda c: not c.website_id or c.website_id and c.website_id.id == website.id) or None
-        return self.public_categ_ids or None
+        return categories or None
 
     def resolve_allow_out_of_stock(self, info):
         return self.allow_out_of_stock_order or None
@@ -566,13 +657,10 @@ class Product(OdooObjectType):
         return self.show_availability or None
 
     def resolve_ribbon(self, info):
-        return self.website_ribbon_id or None
+        return load_relation(info, self, 'website_ribbon_id') or None
 
     def resolve_is_in_stock(self, info):
-        if self._name == 'product.template':
-            return bool(sum(self.product_variant_ids.mapped('free_qty')) > 0)
-        else:
-            return bool(self.free_qty > 0)
+        return bool(load_stock_qty(info, self) > 0)
 
     # TODO: check request object does not contain website
     def resolve_is_in_wishlist(self, info):
@@ -582,28 +670,27 @@ class Product(OdooObjectType):
 
     def resolve_media_gallery(self, info):
         if self._name == 'product.template':
-            return self.product_template_image_ids or None
+            return load_relation(info, self, 'product_template_image_ids') or None
         else:
-            return self.product_template_image_ids + self.product_variant_image_ids or None
+            return load_relation(info, self, 'product_template_image_ids') + \
+                load_relation(info, self, 'product_variant_image_ids') or None
 
     def resolve_qty(self, info):
-        if self._name == 'product.template':
-            return sum(self.product_variant_ids.mapped('free_qty'))
-        else:
-            return self.free_qty
+        return load_stock_qty(info, self)
 
     def resolve_slug(self, info):
         return self.website_slug
 
     def resolve_alternative_products(self, info):
-        return self.alternative_product_ids or None
+        return load_relation(info, self, 'alternative_product_ids') or None
 
     def resolve_accessory_products(self, info):
-        return self.accessory_product_ids or None
+        return load_relation(info, self, 'accessory_product_ids') or None
 
     def resolve_frequently_bought_together(self, info):
-        if self.frequently_bought_together_ids:
-            fbt = self.frequently_bought_together_ids.sorted(key=lambda r: r.qty, reverse=True)
+        frequently_bought_together = load_relation(info, self, 'frequently_bought_together_ids')
+        if frequently_bought_together:
+            fbt = frequently_bought_together.sorted(key=lambda r: r.qty, reverse=True)
             return fbt.mapped('related_product_id')
         return None
 
@@ -675,12 +762,12 @@ class Product(OdooObjectType):
     def resolve_variant_attribute_values(self, info):
         if self._name == 'product.template':
             return self.product_variant_id.product_template_attribute_value_ids or None
-        return self.product_template_attribute_value_ids or None
+        return load_relation(info, self, 'product_template_attribute_value_ids') or None
 
     def resolve_product_template(self, info):
         if self._name == 'product.template':
             return None
-        return self.product_tmpl_id or None
+        return load_relation(info, self, 'product_tmpl_id') or None
 
     # Specific to use in Product Template
     def resolve_combination_info(self, info):
@@ -737,13 +824,13 @@ class Product(OdooObjectType):
         return self.attribute_line_ids.product_template_value_ids or None
 
     def resolve_product_variants(self, info):
-        return self.product_variant_ids or None
+        return load_relation(info, self, 'product_variant_ids') or None
 
     def resolve_first_variant(self, info):
         return self.product_variant_id or None
 
     def resolve_tags(self, info):
-        return self.product_tag_ids.filtered(lambda t: t.visible_on_ecommerce) or None
+        return load_relation(info, self, 'product_tag_ids').filtered(lambda t: t.visible_on_ecommerce) or None
 
 
 class Payment(OdooObjectType):
@@ -795,22 +882,23 @@ class OrderLine(OdooObjectType):
     coupon = graphene.Field(lambda: Coupon)
 
     def resolve_product(self, info):
-        return self.product_id or None
+        return load_relation(info, self, 'product_id') or None
 
     def resolve_quantity(self, info):
         return self.product_uom_qty or None
 
     def resolve_gift_card(self, info):
         gift_card = None
-        if self.coupon_id and self.coupon_id.program_type and self.coupon_id.program_type == 'gift_card':
-            gift_card = self.coupon_id
+        coupon = load_relation(info, self, 'coupon_id')
+        if coupon and coupon.program_type and coupon.program_type == 'gift_card':
+            gift_card = coupon
         return gift_card
 
     def resolve_coupon(self, info):
-        coupon = None
-        if self.coupon_id and self.coupon_id.program_type and self.coupon_id.program_type == 'coupons':
-            coupon = self.coupon_id
-        return coupon
+        coupon = load_relation(info, self, 'coupon_id')
+        if coupon and coupon.program_type and coupon.program_type == 'coupons':
+            return coupon
+        return None
 
 
 class Coupon(OdooObjectType):
@@ -871,13 +959,13 @@ class Order(OdooObjectType):
     report_order_line = graphene.List(graphene.NonNull(lambda: OrderLine))
 
     def resolve_partner(self, info):
-        return self.partner_id or None
+        return load_relation(info, self, 'partner_id') or None
 
     def resolve_partner_shipping(self, info):
-        return self.partner_shipping_id or None
+        return load_relation(info, self, 'partner_shipping_id') or None
 
     def resolve_partner_invoice(self, info):
-        return self.partner_invoice_id or None
+        return load_relation(info, self, 'partner_invoice_id') or None
 
     def resolve_date_order(self, info):
         return self.date_order or None
@@ -886,13 +974,13 @@ class Order(OdooObjectType):
         return self.tax_totals or None
 
     def resolve_shipping_method(self, info):
-        return self.carrier_id or None
+        return load_relation(info, self, 'carrier_id') or None
 
     def resolve_currency(self, info):
-        return self.currency_id or None
+        return load_relation(info, self, 'currency_id') or None
 
     def resolve_order_lines(self, info):
-        return self.order_line or None
+        return load_relation(info, self, 'order_line') or None
 
     def resolve_website_order_line(self, info):
         return self.website_order_line.filtered(lambda l: l.id and l.product_id) or None
@@ -904,32 +992,33 @@ class Order(OdooObjectType):
         return self.get_portal_url() or None
 
     def resolve_transactions(self, info):
-        return self.transaction_ids or None
+        return load_relation(info, self, 'transaction_ids') or None
 
     def resolve_last_transaction(self, info):
-        if self.transaction_ids:
-            return self.transaction_ids.sorted(key=lambda r: r.create_date, reverse=True)[0]
+        transactions = load_relation(info, self, 'transaction_ids')
+        if transactions:
+            return transactions.sorted(key=lambda r: r.create_date, reverse=True)[0]
         return None
 
     def resolve_amount_subtotal(self, info):
-        subtotal_lines = self.order_line.filtered(lambda l: not l.is_reward_line)
+        subtotal_lines = load_relation(info, self, 'order_line').filtered(lambda l: not l.is_reward_line)
         return sum(subtotal_lines.mapped('price_total')) - self.amount_delivery
 
     def resolve_amount_discounts(self, info):
-        return sum(self.order_line.filtered(
+        return sum(load_relation(info, self, 'order_line').filtered(
             lambda l: l.coupon_id and l.coupon_id.program_type and
                       l.coupon_id.program_type != 'gift_card').mapped('price_total'))
 
     def resolve_amount_gift_cards(self, info):
-        return sum(self.order_line.filtered(
+        return sum(load_relation(info, self, 'order_line').filtered(
             lambda l: l.coupon_id and l.coupon_id.program_type and
                       l.coupon_id.program_type == 'gift_card').mapped('price_total'))
 
     def resolve_coupons(self, info):
-        return self.applied_coupon_ids.filtered(lambda c: c.program_type == 'coupons') or None
+        return load_relation(info, self, 'applied_coupon_ids').filtered(lambda c: c.program_type == 'coupons') or None
 
     def resolve_gift_cards(self, info):
-        return self.applied_coupon_ids.filtered(lambda c: c.program_type == 'gift_card') or None
+        return load_relation(info, self, 'applied_coupon_ids').filtered(lambda c: c.program_type == 'gift_card') or None
 
     def resolve_cart_quantity(self, info):
         return self.cart_quantity or None
@@ -1107,13 +1196,13 @@ class WebsiteMenu(OdooObjectType):
     images = graphene.List(graphene.NonNull(lambda: WebsiteMenuImage))
 
     def resolve_parent(self, info):
-        return self.parent_id or None
+        return load_relation(info, self, 'parent_id') or None
 
     def resolve_childs(self, info):
-        return self.child_id or None
+        return load_relation(info, self, 'child_id') or None
 
     def resolve_images(self, info):
-        return self.menu_image_ids or None
+        return load_relation(info, self, 'menu_image_ids') or None
 
 
 class WebsiteMenuImage(OdooObjectType):
@@ -5,12 +5,15 @@
 import graphene
 from graphql import GraphQLError
 from odoo.http import request
+from odoo.osv import expression
 from odoo import _
 
 from odoo.addons.graphql_alokai.schemas.objects import (
     SortEnum, OrderStage, InvoiceStatus, Order, ShippingMethod,
     get_document_with_check_access,
-    get_document_count_with_check_access
+    get_document_count_with_check_access,
+    get_next_search_cursor,
+    get_search_cursor_domain
 )
 
 
@@ -45,6 +48,7 @@ class OrderSortInput(graphene.InputObjectType):
 class Orders(graphene.Interface):
     orders = graphene.List(Order)
     total_count = graphene.Int(required=True)
+    next_cursor = graphene.String()
 
 
 class OrderList(graphene.ObjectType):
@@ -63,7 +67,9 @@ class OrderQuery(graphene.ObjectType):
         filter=graphene.Argument(OrderFilterInput, default_value={}),
         current_page=graphene.Int(default_value=1),
         page_size=graphene.Int(default_value=10),
-        sort=graphene.Argument(OrderSortInput, default_value={})
+        sort=graphene.Argument(OrderSortInput, default_value={}),
+        after=graphene.String(default_value=None),
+        first=graphene.Int(default_value=None)
     )
     delivery_methods = graphene.List(
         graphene.NonNull(ShippingMethod)
@@ -79,7 +85,7 @@ class OrderQuery(graphene.ObjectType):
         return order.sudo()
 
     @staticmethod
-    def resolve_orders(self, info, filter, current_page, page_size, sort):
+    def resolve_orders(self, info, filter, current_page, page_size, sort, after=None, first=None):
         env = info.context["env"]
         user = request.env.user
         partner = user.partner_id
@@ -107,10 +113,19 @@ class OrderQuery(graphene.ObjectType):
             offset = 0
 
         SaleOrder = env["sale.order"]
+        total_count = get_document_count_with_check_access(SaleOrder, domain)
+
+        # Keyset pagination, the cursor replaces the offset
+        if after or first:
+            page_size = first or page_size
+            offset = 0
+            domain = expression.AND([domain, get_search_cursor_domain(SaleOrder, sort_order, after)])
+
         orders = get_document_with_check_access(SaleOrder, domain, sort_order, page_size, offset,
                                                 error_msg='Sale Order does not exist.')
-        total_count = get_document_count_with_check_access(SaleOrder, domain)
-        return OrderList(orders=orders and orders.sudo() or orders, total_count=total_count)
+        next_cursor = get_next_search_cursor(orders, sort_order, page_size)
+        return OrderList(orders=orders and orders.sudo() or orders, total_count=total_count,
+                         next_cursor=next_cursor)
 
     @staticmethod
     def resolve_delivery_methods(self, info):
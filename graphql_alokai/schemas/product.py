@@ -6,131 +6,76 @@ import graphene
 from odoo.osv import expression
 from graphql import GraphQLError
 from odoo import _
-from collections import defaultdict
 from graphene.types import generic
 from odoo.addons.graphql_alokai.schemas.objects import (
-    SortEnum, Product, Attribute, AttributeValue
+    SortEnum, Product, Attribute, AttributeValue,
+    get_next_search_cursor,
+    get_search_cursor_domain
 )
 
+PRODUCT_LIST_MAX_PAGE_SIZE = 500
 
-def get_product_list(env, current_page, page_size, search, sort, **kwargs):
+
+def get_product_list(env, current_page, page_size, search, sort, after=None, first=None, **kwargs):
     Product = env['product.template'].sudo()
     Category = env['product.public.category'].sudo()
     domain, attributes_partial_domain, prices_partial_domain, filtered_attributes = Product._graphql_get_search_domain(search, **kwargs)
 
+    # Postgres rejects a negative limit and Odoo reads every product with a limit of 0, so an empty page is returned
+    if page_size < 0 or (first is not None and first < 0):
+        raise GraphQLError(_('Invalid page size.'))
+    page_size = min(page_size, PRODUCT_LIST_MAX_PAGE_SIZE)
+    first = first and min(first, PRODUCT_LIST_MAX_PAGE_SIZE)
+
     # First offset is 0 but first page is 1
     if current_page > 1:
         offset = (current_page - 1) * page_size
     else:
         offset = 0
     order = Product._graphql_get_search_order(sort)
-    products = Product.search(expression.AND(domain), order=order)
+
+    # Keyset pagination, the cursor replaces the offset
+    if after or first:
+        page_size = first or page_size
+        offset = 0
+        domain = domain + [get_search_cursor_domain(Product, order, after)]
+
+    products = Product.search(expression.AND(domain), order=order, limit=page_size, offset=offset) \
+        if page_size else Product.browse()
+    next_cursor = get_next_search_cursor(products, order, page_size)
     attribute_values = env['product.attribute.value'].sudo()
     filter_counts = []
-    attribute_value_counts = defaultdict(int)
-
-    if products:
-        filtered_attribute_values = env['product.attribute.value'].sudo()
-        # Attempt to get attribute values from category, otherwise fallback to attribute values from products
-        category = None
-        if kwargs.get('category_id'):
-            category = Category.search([('id', 'in', kwargs['category_id'])], limit=1)
-        elif kwargs.get('category_slug'):
-            category = Category.search([('website_slug', '=', kwargs['category_slug'])], limit=1)
-        if category:
-            filtered_attribute_values = category.\
-                mapped('attribute_ids').\
-                mapped('value_ids').\
-                filtered(lambda av: av.visibility and av.visibility == 'visible')
-
-        # Attributes from category, they still need to be filtered based on the products we are returning
-        if filtered_attribute_values:
-            category_attribute_value_ids = filtered_attribute_values.ids
-            product_attribute_value_ids = products.\
-                mapped('variant_attribute_value_ids').\
-                filtered(lambda av: av.visibility and av.visibility == 'visible').ids
-            # Convert lists to sets and find the intersection to make sure attributes from category exist on products
-            common_ids = list(set(category_attribute_value_ids) & set(product_attribute_value_ids))
-            filtered_attribute_values = filtered_attribute_values.filtered(lambda av: av.id in common_ids)
-        else:
-            # Attributes from products
-            filtered_attribute_values = products.\
-                mapped('variant_attribute_value_ids').\
-                filtered(lambda av: av.visibility and av.visibility == 'visible')
-
-        # Our goal is to retrieve attribute values from filtered products to ensure that results are always returned,
-        # regardless of the applied filters. A key challenge is that simply retrieving attribute values from filtered
-        # products restricts us to values that match the filter criteria (e.g., filtering for green shoes only yields
-        # the "green" color, excluding other colors).
-        #
-        # To address this, we’ll use the following approach:
-        # 1. First, we collect all attribute values from the filtered products that were not included in the filter
-        #    criteria.
-        # 2. For each attribute, we retrieve products filtered by the remaining attributes, excluding the specific
-        #    attribute in question.
-        # 3. Finally, we cross-check these results to determine which attribute values within the attribute in question
-        #    have products available.
-
-        # Step 1.
-        filtered_attribute_value_ids = list(set(num for sublist in filtered_attributes.values() for num in sublist))
-        # Used for counting attribute values
-        products_attribute_value_ids = [set(p.attribute_line_ids.value_ids.ids) for p in products]
-        for filtered_attribute_value in filtered_attribute_values:
-            if filtered_attribute_value.id not in filtered_attribute_value_ids:
-                attribute_values |= filtered_attribute_value
-
-                attribute_value_counts[filtered_attribute_value.id] += sum(
-                    1
-                    for products_attribute_value_id in products_attribute_value_ids
-                    if filtered_attribute_value.id in products_attribute_value_id
-                )
-
-        # Step 2. and 3.
-        for attribute_id, attribute_value_ids in filtered_attributes.items():
-            new_domain = attributes_partial_domain.copy()
-            attributes_domain = []
-
-            # Step 2.
-            for f_attribute_id, f_attribute_value_ids in filtered_attributes.items():
-                if attribute_id == f_attribute_id:
-                    continue
-                attributes_domain.append([('attribute_line_ids.value_ids', 'in', f_attribute_value_ids)])
-
-            attributes_domain = expression.AND(attributes_domain)
-            new_domain.append(attributes_domain)
-            new_domain = expression.AND(new_domain)
-
-            partial_products = Product.search(new_domain)
-            partial_attribute_values = partial_products.search(new_domain). \
-                mapped('variant_attribute_value_ids'). \
-                filtered(lambda av: av.attribute_id.id == attribute_id and av.visibility and av.visibility == 'visible')
-
-            # Step 3.
-            attribute_values |= partial_attribute_values
-
-            # Used for counting attribute values
-            products_attribute_value_ids = [set(p.attribute_line_ids.value_ids.ids) for p in partial_products]
-            for partial_attribute_value in partial_attribute_values:
-                attribute_value_counts[partial_attribute_value.id] += sum(
-                    1
-                    for products_attribute_value_id in products_attribute_value_ids
-                    if partial_attribute_value.id in products_attribute_value_id
-                    and partial_attribute_value.id in attribute_values.ids
-                )
-
-    # The partial domain is being used because when we select (example) attributes, the full list of products is
-    # reduced which in turn also reduces the min and max prices
-    if domain == prices_partial_domain:
-        prices = products.mapped('list_price')
-    else:
-        prices = Product.search(expression.AND(prices_partial_domain)).mapped('list_price')
 
-    if prices:
-        min_price = min(prices)
-        max_price = max(prices)
-    else:
-        min_price = 0.0
-        max_price = 0.0
+    # Attempt to get attribute values from category, otherwise fallback to attribute values from products
+    category_attribute_value_ids = None
+    category = None
+    if kwargs.get('category_id'):
+        category = Category.search([('id', 'in', kwargs['category_id'])], limit=1)
+    elif kwargs.get('category_slug'):
+        category = Category.search([('website_slug', '=', kwargs['category_slug'])], limit=1)
+    if category:
+        category_attribute_value_ids = category.\
+            mapped('attribute_ids').\
+            mapped('value_ids').\
+            filtered(lambda av: av.visibility and av.visibility == 'visible').ids
+
+    # Attribute values, prices and stock are counted in a single aggregation. The values of a filtered attribute are
+    # counted without the filter on that attribute, so selecting (example) green shoes still lists the other colors.
+    facets = Product._graphql_get_facets(
+        expression.AND(attributes_partial_domain),
+        filtered_attributes,
+        min_price=kwargs.get('min_price'),
+        max_price=kwargs.get('max_price'),
+        attribute_value_ids=category_attribute_value_ids,
+    )
+    attribute_value_counts = facets['attribute_value_counts']
+    total_count = facets['total_count']
+
+    if total_count and attribute_value_counts:
+        attribute_values = attribute_values.browse(list(attribute_value_counts)).sorted()
+
+    min_price = facets['min_price']
+    max_price = facets['max_price']
 
     # Count attribute filters
     if attribute_values:
@@ -140,32 +85,19 @@ def get_product_list(env, current_page, page_size, search, sort, **kwargs):
             'total': attribute_value_counts[av.id],
         } for av in attribute_values])
 
-    total_count = len(products)
-    products = products[offset:offset + page_size]
-
     # Count products in stock
-    if kwargs.get('in_stock', False):
-        filter_counts.append({
-            'type': 'in_stock',
-            'total': total_count,
-        })
-    else:
-        website = env['website'].get_current_website()
-        domain.append([
-            ('product_tmpl_redis_stock_ids.quantity', '>', 0),
-            ('product_tmpl_redis_stock_ids.website_id', '=', website.id)
-        ])
-        filter_counts.append({
-            'type': 'in_stock',
-            'total': Product.search_count(expression.AND(domain)),
-        })
+    filter_counts.append({
+        'type': 'in_stock',
+        'total': facets['in_stock_count'],
+    })
 
-    return products, total_count, attribute_values, min_price, max_price, filter_counts
+    return products, total_count, attribute_values, min_price, max_price, filter_counts, next_cursor
 
 
 class Products(graphene.Interface):
     products = graphene.List(Product)
     total_count = graphene.Int(required=True)
+    next_cursor = graphene.String()
     attribute_values = graphene.List(AttributeValue)
     min_price = graphene.Float()
     max_price = graphene.Float()
@@ -227,7 +159,9 @@ class ProductQuery(graphene.ObjectType):
         current_page=graphene.Int(default_value=1),
         page_size=graphene.Int(default_value=20),
         search=graphene.String(default_value=False),
-        sort=graphene.Argument(ProductSortInput, default_value={})
+        sort=graphene.Argument(ProductSortInput, default_value={}),
+        after=graphene.String(default_value=None),
+        first=graphene.Int(default_value=None)
     )
     attribute = graphene.Field(
         Attribute,
@@ -262,12 +196,13 @@ class ProductQuery(graphene.ObjectType):
         return product
 
     @staticmethod
-    def resolve_products(self, info, filter, current_page, page_size, search, sort):
+    def resolve_products(self, info, filter, current_page, page_size, search, sort, after=None, first=None):
         env = info.context["env"]
-        products, total_count, attribute_values, min_price, max_price, filter_counts = get_product_list(
-            env, current_page, page_size, search, sort, **filter)
+        products, total_count, attribute_values, min_price, max_price, filter_counts, next_cursor = get_product_list(
+            env, current_page, page_size, search, sort, after=after, first=first, **filter)
         return ProductList(products=products, total_count=total_count, attribute_values=attribute_values,
-                           min_price=min_price, max_price=max_price, filter_counts=filter_counts)
+                           min_price=min_price, max_price=max_price, filter_counts=filter_counts,
+                           next_cursor=next_cursor)
 
     @staticmethod
     def resolve_attribute(self, info, id):
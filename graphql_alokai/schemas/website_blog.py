@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 import graphene
 from odoo import _
+from odoo.osv import expression
 from odoo.addons.graphql_alokai.schemas.objects import (
     BlogPost,
     BlogTag,
     SortEnum,
     get_document_with_check_access,
+    get_document_count_with_check_access,
+    get_next_search_cursor,
+    get_search_cursor_domain,
 )
 
 
@@ -23,6 +27,7 @@ class BlogPosts(graphene.Interface):
     blog_posts = graphene.List(BlogPost)
     blog_tags = graphene.List(BlogTag)
     total_count = graphene.Int(required=True)
+    next_cursor = graphene.String()
 
 
 class BlogPostFilterInput(graphene.InputObjectType):
@@ -57,7 +62,9 @@ class BlogPostQuery(graphene.ObjectType):
         current_page=graphene.Int(default_value=1),
         page_size=graphene.Int(default_value=10),
         search=graphene.String(default_value=False),
-        sort=graphene.Argument(BlogPostSortInput, default_value={})
+        sort=graphene.Argument(BlogPostSortInput, default_value={}),
+        after=graphene.String(default_value=None),
+        first=graphene.Int(default_value=None)
     )
 
     @staticmethod
@@ -87,7 +94,7 @@ class BlogPostQuery(graphene.ObjectType):
         return blog_post.sudo()
 
     @staticmethod
-    def resolve_blog_posts(self, info, filter, current_page, page_size, search, sort):
+    def resolve_blog_posts(self, info, filter, current_page, page_size, search, sort, after=None, first=None):
         env = info.context["env"]
         BlogPost = env['blog.post']
 
@@ -101,9 +108,18 @@ class BlogPostQuery(graphene.ObjectType):
             offset = 0
 
         BlogPost = env['blog.post']
-        blog_posts = get_document_with_check_access(BlogPost, domain, sort_order, limit=0)
-        blog_posts=blog_posts and blog_posts.sudo() or blog_posts
-        total_count = len(blog_posts)
-        blog_tags = blog_posts.mapped('tag_ids').sorted(key=lambda b: (b.name, b.id))
-        blog_posts = blog_posts[offset:offset + page_size]
-        return BlogPostList(blog_posts=blog_posts, blog_tags=blog_tags, total_count=total_count)
+        total_count = get_document_count_with_check_access(BlogPost, domain)
+        blog_tags = env['blog.tag'].sudo().search([('post_ids', 'any', domain)]) if total_count else env['blog.tag']
+        blog_tags = blog_tags.sorted(key=lambda b: (b.name, b.id))
+
+        # Keyset pagination, the cursor replaces the offset
+        if after or first:
+            page_size = first or page_size
+            offset = 0
+            domain = expression.AND([domain, get_search_cursor_domain(BlogPost, sort_order, after)])
+
+        blog_posts = get_document_with_check_access(BlogPost, domain, sort_order, page_size, offset)
+        blog_posts = blog_posts and blog_posts.sudo() or blog_posts
+        next_cursor = get_next_search_cursor(blog_posts, sort_order, page_size)
+        return BlogPostList(blog_posts=blog_posts, blog_tags=blog_tags, total_count=total_count,
+                            next_cursor=next_cursor)
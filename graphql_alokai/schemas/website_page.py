@@ -2,9 +2,12 @@
 import graphene
 
 from odoo.http import request
+from odoo.osv import expression
 from odoo.addons.graphql_alokai.schemas.objects import (
     SortEnum,
     WebsitePage,
+    get_next_search_cursor,
+    get_search_cursor_domain,
 )
 
 
@@ -39,6 +42,7 @@ class WebsitePageSortInput(graphene.InputObjectType):
 class WebsitePages(graphene.Interface):
     website_pages = graphene.List(WebsitePage)
     total_count = graphene.Int(required=True)
+    next_cursor = graphene.String()
 
 
 class WebsitePageList(graphene.ObjectType):
@@ -58,7 +62,9 @@ class WebsitePageQuery(graphene.ObjectType):
         current_page=graphene.Int(default_value=1),
         page_size=graphene.Int(default_value=20),
         search=graphene.String(default_value=False),
-        sort=graphene.Argument(WebsitePageSortInput, default_value={})
+        sort=graphene.Argument(WebsitePageSortInput, default_value={}),
+        after=graphene.String(default_value=None),
+        first=graphene.Int(default_value=None)
     )
 
     @staticmethod
@@ -79,7 +85,7 @@ class WebsitePageQuery(graphene.ObjectType):
         return website_page
 
     @staticmethod
-    def resolve_website_pages(self, info, filter, current_page, page_size, search, sort):
+    def resolve_website_pages(self, info, filter, current_page, page_size, search, sort, after=None, first=None):
         env = info.context["env"]
         website = env['website'].get_current_website()
         request.website = website
@@ -109,5 +115,13 @@ class WebsitePageQuery(graphene.ObjectType):
 
         WebsitePage = env['alokai.website.page'].sudo()
         total_count = WebsitePage.search_count(domain)
+
+        # Keyset pagination, the cursor replaces the offset
+        if after or first:
+            page_size = first or page_size
+            offset = 0
+            domain = expression.AND([domain, get_search_cursor_domain(WebsitePage, order, after)])
+
         website_pages = WebsitePage.search(domain, limit=page_size, offset=offset, order=order)
-        return WebsitePageList(website_pages=website_pages, total_count=total_count)
+        next_cursor = get_next_search_cursor(website_pages, order, page_size)
+        return WebsitePageList(website_pages=website_pages, total_count=total_count, next_cursor=next_cursor)
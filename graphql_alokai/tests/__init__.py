@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+from . import test_benchmark_cache
+from . import test_benchmark_graphql
+from . import test_benchmark_image
+from . import test_invalidate_cache
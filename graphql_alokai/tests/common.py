@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import json
+import time
+
+from odoo.tests import HttpCase
+
+
+class AlokaiBenchmarkCase(HttpCase):
+    """
+    Benchmarks are not part of the standard tests, run them with --test-tags /graphql_alokai:alokai_benchmark.
+    The request benchmarks only go through the public routes, so they can be run on the revisions before and after
+    a change to compare the figures they log.
+    """
+
+    def _graphql_request(self, query, variables=None, extensions=None):
+        payload = {'query': query, 'variables': variables or {}}
+        if extensions:
+            payload['extensions'] = extensions
+        return self.url_open('/graphql/alokai', data=json.dumps(payload), headers={'Content-Type': 'application/json'})
+
+    def _measure_graphql_request(self, query, variables=None):
+        """ Return the SQL query count and the duration of a GraphQL request, once the caches are warm """
+        response = self._graphql_request(query, variables)
+        self.assertEqual(response.status_code, 200, response.text)
+        self.assertNotIn('errors', response.json(), response.text)
+
+        sql_count = self.registry.test_cr.sql_log_count
+        start = time.perf_counter()
+        self._graphql_request(query, variables)
+        duration = time.perf_counter() - start
+        return self.registry.test_cr.sql_log_count - sql_count, duration
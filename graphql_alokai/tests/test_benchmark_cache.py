@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import logging
+import time
+
+from odoo.tests import TransactionCase, tagged
+
+_logger = logging.getLogger(__name__)
+
+
+@tagged('post_install', '-at_install', '-standard', 'alokai_benchmark')
+class TestBenchmarkCache(TransactionCase):
+
+    def test_product_write_invalidation(self):
+        """ Mass write of 10k products with the cache invalidation on, the queue being filled by the write """
+        self.env['ir.config_parameter'].sudo().set_param('alokai_cache_invalidation', True)
+        products = self.env['product.template'].create([{'name': f'Benchmark {index}'} for index in range(10000)])
+        self.env.flush_all()
+
+        sql_count = self.cr.sql_log_count
+        start = time.perf_counter()
+        products.write({'list_price': 42.0})
+        self.env.flush_all()
+        duration = time.perf_counter() - start
+
+        queued = self.env['invalidate.cache'].search_count(
+            [('res_model', '=', 'product.template'), ('res_id', 'in', products.ids)])
+        self.assertEqual(queued, len(products))
+        _logger.info('Write of %s products: %s SQL queries, %.1f ms',
+                     len(products), self.cr.sql_log_count - sql_count, duration * 1000)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import logging
+import timeit
+
+from odoo.tests import tagged
+
+from ..controllers.persisted_query import get_query_hash, parse_and_validate, persisted_query_cache
+from ..schema import schema
+from .common import AlokaiBenchmarkCase
+
+_logger = logging.getLogger(__name__)
+
+# Product listing page of the storefront
+PLP_QUERY = """
+query ProductListing($filter: ProductFilterInput, $pageSize: Int) {
+    products(filter: $filter, pageSize: $pageSize) {
+        totalCount
+        products {
+            id
+            name
+            slug
+            image
+            imageFilename
+            price
+            isInStock
+            categories { id name slug }
+            ribbon { id displayName }
+            tags { name color }
+            productVariants { id name }
+            firstVariant { id }
+        }
+    }
+}
+"""
+
+# Product page of the storefront
+PDP_QUERY = """
+query Product($slug: String) {
+    product(slug: $slug) {
+        id
+        name
+        description
+        slug
+        image
+        price
+        combinationInfo
+        attributeValues { id name }
+        mediaGallery { id name }
+        alternativeProducts { id name slug image price }
+        accessoryProducts { id name slug image price }
+    }
+}
+"""
+
+# Category tree of the storefront
+CATEGORIES_QUERY = """
+query Categories($pageSize: Int) {
+    categories(pageSize: $pageSize) {
+        totalCount
+        categories { id name slug parent { id name slug } childs { id name slug } }
+    }
+}
+"""
+
+
+@tagged('post_install', '-at_install', '-standard', 'alokai_benchmark')
+class TestBenchmarkGraphql(AlokaiBenchmarkCase):
+
+    def test_product_listing_query_count(self):
+        """ SQL queries of a 48 products listing page, batched by level of the query tree """
+        category = self.env['product.public.category'].search([('product_tmpl_ids', '!=', False)], limit=1)
+        variables = {'filter': {'categoryId': category.ids}, 'pageSize': 48}
+
+        query_count, duration = self._measure_graphql_request(PLP_QUERY, variables)
+        _logger.info('Product listing page: %s SQL queries, %.1f ms', query_count, duration * 1000)
+
+    def test_persisted_query_cache(self):
+        """ Parse and validation of the storefront queries, against a hit of the parsed document cache """
+        number = 200
+        for name, query in (('listing', PLP_QUERY), ('product', PDP_QUERY), ('categories', CATEGORIES_QUERY)):
+            document, errors = parse_and_validate(schema.graphql_schema, query)
+            self.assertFalse(errors)
+            query_hash = get_query_hash(query)
+            persisted_query_cache.set(query_hash, document)
+
+            parse_duration = timeit.timeit(lambda: parse_and_validate(schema.graphql_schema, query), number=number)
+            hit_duration = timeit.timeit(
+                lambda: persisted_query_cache.get(get_query_hash(query)), number=number)
+            _logger.info('Query %s: parse and validate %.3f ms, cache hit %.3f ms',
+                         name, parse_duration / number * 1000, hit_duration / number * 1000)
+
+    def test_persisted_query_request(self):
+        """ Duration of whole requests sending the query text, against sending only the hash of a persisted query """
+        number = 20
+        variables = {'pageSize': 20}
+        query_hash = get_query_hash(CATEGORIES_QUERY)
+        extensions = {'persistedQuery': {'version': 1, 'sha256Hash': query_hash}}
+        response = self._graphql_request(CATEGORIES_QUERY, variables, extensions)
+        self.assertNotIn('errors', response.json(), response.text)
+
+        def request(query, request_extensions=None):
+            response = self._graphql_request(query, variables, request_extensions)
+            self.assertNotIn('errors', response.json(), response.text)
+
+        query_duration = timeit.timeit(lambda: request(CATEGORIES_QUERY), number=number)
+        hash_duration = timeit.timeit(lambda: request(None, extensions), number=number)
+        _logger.info('Categories request: with the query %.1f ms, with the persisted query hash %.1f ms',
+                     query_duration / number * 1000, hash_duration / number * 1000)
+
+    def test_website_context_query_count(self):
+        """ SQL queries of a request resolving no field, the cost of the request and of the website resolution """
+        query_count, duration = self._measure_graphql_request('query { __typename }')
+        _logger.info('Empty GraphQL request: %s SQL queries, %.1f ms', query_count, duration * 1000)
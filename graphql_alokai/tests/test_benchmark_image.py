@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import base64
+import io
+import logging
+import os
+import time
+
+from PIL import Image
+
+from odoo.tests import tagged
+
+from ..models.ir_binary import IMAGE_FORMATS, get_supported_image_formats, render_image
+from .common import AlokaiBenchmarkCase
+
+_logger = logging.getLogger(__name__)
+
+
+def get_noise_image(size=1920):
+    """ A new photo like image, so its derivatives are not cached yet """
+    image = Image.frombytes('RGB', (size, size), os.urandom(size * size * 3))
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+
+@tagged('post_install', '-at_install', '-standard', 'alokai_benchmark')
+class TestBenchmarkImage(AlokaiBenchmarkCase):
+
+    def _measure_image_request(self, url):
+        start = time.perf_counter()
+        response = self.url_open(url, headers={'Accept': 'image/avif,image/webp,*/*'})
+        duration = time.perf_counter() - start
+        self.assertEqual(response.status_code, 200)
+        return duration, len(response.content)
+
+    def test_resized_image_latency(self):
+        """ Latency of a resized product image, cold then served from the derivative cache """
+        product = self.env['product.template'].create({
+            'name': 'Benchmark Image',
+            'is_published': True,
+            'image_1920': base64.b64encode(get_noise_image()),
+        })
+        url = f'/web/image/product.template/{product.id}/image_1920/512x512'
+
+        cold, size = self._measure_image_request(url)
+        warm = min(self._measure_image_request(url)[0] for __ in range(5))
+        _logger.info('Resized image of %s bytes: cold %.1f ms, warm %.1f ms', size, cold * 1000, warm * 1000)
+
+    def test_image_format_encoding(self):
+        """ Size and encode time of each output format, on the product images of the catalog """
+        products = self.env['product.template'].search([('image_1920', '!=', False)], limit=50)
+        sources = [base64.b64decode(product.image_1920) for product in products]
+        if not sources:
+            sources = [get_noise_image()]
+
+        settings = self.env['alokai.settings']
+        background_rgba = self.env['ir.binary']._get_image_background_rgba()
+        for image_format in get_supported_image_formats():
+            quality = settings.get(IMAGE_FORMATS[image_format][2])
+            size, duration = 0, 0.0
+            for data in sources:
+                start = time.perf_counter()
+                size += len(render_image(data, 512, 512, False, background_rgba, quality, image_format))
+                duration += time.perf_counter() - start
+            _logger.info('%s at quality %s, %s images: %.0f bytes and %.1f ms per image',
+                         image_format.upper(), quality, len(sources), size / len(sources),
+                         duration / len(sources) * 1000)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlparse
+
+from odoo.tests import TransactionCase, tagged
+
+from ..models import invalidate_cache
+from ..models.invalidate_cache import split_tags
+
+
+class PurgeHandler(BaseHTTPRequestHandler):
+    """ Storefront purge endpoint, failing the requests containing a failing tag """
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        tags = query.get('tags', [''])[0].split(',')
+        with self.server.lock:
+            self.server.requests.append((query.get('key', [None])[0], tags))
+            failures = self.server.failures
+            status = 503 if any(failures.get(tag, 0) for tag in tags) else 200
+            for tag in tags:
+                if failures.get(tag, 0) > 0:
+                    failures[tag] -= 1
+        self.send_response(status)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@tagged('post_install', '-at_install')
+class TestInvalidateCache(TransactionCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), PurgeHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        # Number of failed responses per tag, -1 to always fail
+        self.server.failures = {}
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/purge'
+
+        ICP = self.env['ir.config_parameter'].sudo()
+        ICP.set_param('alokai_cache_invalidation', True)
+        ICP.set_param('alokai_cache_invalidation_url', self.url)
+        ICP.set_param('alokai_cache_invalidation_key', 'secret')
+
+        self.InvalidateCache = self.env['invalidate.cache']
+        self.products = self.env['product.template'].create([{'name': 'Purged'}, {'name': 'Failing'}])
+        self.InvalidateCache.search([]).unlink()
+
+    def _run_cron(self):
+        # One purge request per tag, so each product is acknowledged on its own
+        with patch.object(invalidate_cache, 'split_tags', lambda tags: iter(tags)), \
+                patch.object(self.env.cr, 'commit', lambda: None):
+            self.InvalidateCache.request_alokai_cache_invalidation()
+
+    def _get_queued_ids(self):
+        return set(self.InvalidateCache.search([('res_model', '=', 'product.template')]).mapped('res_id'))
+
+    def test_split_tags(self):
+        tags = [f'P{index}' for index in range(1000)]
+        batches = list(split_tags(tags, max_length=100))
+        self.assertTrue(all(len(batch) <= 100 for batch in batches))
+        self.assertEqual([tag for batch in batches for tag in batch.split(',')], tags)
+        self.assertEqual(list(split_tags([])), [])
+
+    def test_dispatch_retry(self):
+        self.server.failures = {'P1': 2}
+        failed = self.InvalidateCache._dispatch_cache_invalidation(self.url, 'secret', ['P1', 'P2'])
+        self.assertEqual(failed, set())
+        self.assertEqual(len(self.server.requests), 3, 'Two failed attempts, then acknowledged')
+        self.assertTrue(all(key == 'secret' for key, __ in self.server.requests))
+
+    def test_dispatch_failure(self):
+        self.server.failures = {'P1': -1}
+        with self.assertLogs('odoo.addons.graphql_alokai.models.invalidate_cache', level='ERROR'):
+            failed = self.InvalidateCache._dispatch_cache_invalidation(self.url, 'secret', ['P1', 'P2'])
+        self.assertEqual(failed, {'P1', 'P2'}, 'The tags of a failed request are all reported')
+        self.assertEqual(len(self.server.requests), 4, 'The request is retried three times')
+
+    def test_partial_acknowledgement(self):
+        purged, failing = self.products
+        self.products.write({'list_price': 10.0})
+        self.server.failures = {f'P{failing.id}': -1}
+
+        with self.assertLogs('odoo.addons.graphql_alokai.models.invalidate_cache', level='ERROR'):
+            self._run_cron()
+
+        self.assertEqual(self._get_queued_ids(), {failing.id}, 'Only the acknowledged row is dequeued')
+        sent_tags = {tag for __, tags in self.server.requests for tag in tags}
+        self.assertEqual(sent_tags, {f'P{purged.id}', f'P{failing.id}'})
+
+        # The next run sends the remaining purge once the storefront is back
+        self.server.failures = {}
+        self.server.requests = []
+        self._run_cron()
+        self.assertFalse(self._get_queued_ids())
+        self.assertEqual(self.server.requests, [('secret', [f'P{failing.id}'])])
+
+    def test_written_during_purge(self):
+        """ A record written again while its purge is sent stays queued """
+        purged = self.products[0]
+        purged.write({'list_price': 10.0})
+        dispatch = type(self.InvalidateCache)._dispatch_cache_invalidation
+
+        def dispatch_and_write(model, url, key, tags):
+            purged.write({'list_price': 20.0})
+            return dispatch(model, url, key, tags)
+
+        with patch.object(type(self.InvalidateCache), '_dispatch_cache_invalidation', dispatch_and_write):
+            self._run_cron()
+
+        self.assertEqual(self._get_queued_ids(), {purged.id})